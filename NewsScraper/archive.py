@@ -0,0 +1,158 @@
+import json
+import os
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterator
+
+from scrapy import Request
+from scrapy.http import Response
+from scrapy.http.headers import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.request import fingerprint
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def archive_key(request: Request) -> str:
+    """
+    Article responses are stored under the article's news_hash, feed responses under the same hash of their URL.
+    """
+    if init_item := request.cb_kwargs.get('init_item'):
+        return init_item['news_hash']
+    return fingerprint(Request(request.url)).hex()
+
+
+class ResponseArchive:
+    """
+    Raw responses on the local disk, compressed with zstd when zstandard is installed (zlib otherwise), one file per
+    key: ``<directory>/<key[:2]>/<key>.zst`` or ``.zz``.
+
+    A file is a JSON header line (url, status, headers, the kind of response and the article's initial item or the
+    feed's source) followed by the body. The archive is capped at `max_bytes`, the least recently used files are
+    evicted first; reading a file marks it as used.
+    """
+
+    HEADER_READ_SIZE = 16 * 1024
+
+    def __init__(self, directory: str | Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.extension = '.zst' if zstandard is not None else '.zz'
+
+        # path -> size, least recently used first
+        self.files: OrderedDict[Path, int] = OrderedDict()
+        self.total_bytes = 0
+        self.load_index()
+
+    def load_index(self) -> None:
+        if not self.directory.exists():
+            return
+
+        paths = [path for path in self.directory.glob('*/*') if path.suffix in ('.zst', '.zz')]
+        for path, stat in sorted(((path, path.stat()) for path in paths), key=lambda path_stat: path_stat[1].st_mtime):
+            self.files[path] = stat.st_size
+            self.total_bytes += stat.st_size
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def find(self, key: str) -> Path | None:
+        for extension in ('.zst', '.zz'):
+            path = self.directory / key[:2] / f'{key}{extension}'
+            if path in self.files:
+                return path
+        return None
+
+    def store(self, key: str, response: Response, kind: str, init_item: dict = None, source: dict = None) -> int:
+        header = {
+            'url': response.url,
+            'status': response.status,
+            'headers': {
+                name.decode('latin-1'): [value.decode('latin-1') for value in values]
+                for name, values in response.headers.items()
+            },
+            'kind': kind,
+            'init_item': init_item,
+            'source': source,
+        }
+        payload = json.dumps(header).encode('utf-8') + b'\n' + response.body
+
+        if (old_path := self.find(key)) is not None:
+            self.remove(old_path)
+
+        path = self.directory / key[:2] / f'{key}{self.extension}'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = self.compress(payload)
+        path.write_bytes(data)
+
+        self.files[path] = len(data)
+        self.total_bytes += len(data)
+        self.evict()
+        return len(data)
+
+    def load(self, key: str) -> tuple[dict, bytes] | None:
+        if (path := self.find(key)) is None:
+            return None
+
+        header, _, body = self.decompress(path.read_bytes(), path.suffix).partition(b'\n')
+        os.utime(path)
+        self.files.move_to_end(path)
+        return json.loads(header), body
+
+    def load_response(self, key: str, request: Request) -> Response | None:
+        if (loaded := self.load(key)) is None:
+            return None
+
+        header, body = loaded
+        headers = Headers(header['headers'])
+        response_cls = responsetypes.from_args(headers=headers, url=header['url'], body=body)
+        return response_cls(url=header['url'], status=header['status'], headers=headers, body=body, request=request)
+
+    def iter_headers(self, kind: str = None) -> Iterator[dict]:
+        """
+        Yields the headers of the archived responses, only the beginning of every file is decompressed.
+        """
+        for path in list(self.files):
+            header = json.loads(self.read_header(path))
+            if kind is None or header['kind'] == kind:
+                yield header
+
+    def read_header(self, path: Path) -> bytes:
+        with path.open('rb') as archived_file:
+            if path.suffix == '.zst':
+                reader = zstandard.ZstdDecompressor().stream_reader(archived_file)
+                read = reader.read
+            else:
+                decompressor = zlib.decompressobj()
+                read = lambda size: decompressor.decompress(archived_file.read(size))  # noqa: E731
+
+            data = b''
+            while (position := data.find(b'\n')) == -1:
+                if not (chunk := read(self.HEADER_READ_SIZE)):
+                    break
+                data += chunk
+            return data[:position] if position != -1 else data
+
+    def remove(self, path: Path) -> None:
+        self.total_bytes -= self.files.pop(path)
+        path.unlink(missing_ok=True)
+
+    def evict(self) -> None:
+        while self.total_bytes > self.max_bytes and len(self.files) > 1:
+            self.remove(next(iter(self.files)))
+
+    @staticmethod
+    def compress(payload: bytes) -> bytes:
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=10).compress(payload)
+        return zlib.compress(payload, 6)
+
+    @staticmethod
+    def decompress(data: bytes, extension: str) -> bytes:
+        if extension == '.zst':
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
@@ -0,0 +1,75 @@
+import calendar
+import re
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import dateparser
+
+
+class FeedDateParser:
+    """
+    Parses the publication date of a feed entry with the cheapest method that works:
+        - published_parsed: the struct feedparser already parsed (UTC)
+        - rfc822: the RSS date format, e.g. ``Mon, 14 Oct 2024 10:00:00 GMT``
+        - iso8601: the Atom date format, e.g. ``2024-10-14T10:00:00Z``
+        - dateparser: anything else, with language detection and fuzzy formats
+
+    The raw strings are memoized in a bounded LRU cache, feeds repeat the same dates on every poll.
+    """
+
+    # parsedate_to_datetime is lenient, only the strings which are RFC 822 dates are given to it
+    RFC822_RE = re.compile(
+        r'(?:[A-Za-z]{3},\s*)?\d{1,2}\s+[A-Za-z]{3}\s+\d{2,4}\s+\d{1,2}:\d{2}(?::\d{2})?\s*'
+        r'(?:[+-]\d{4}|UT|UTC|GMT|Z|[ECMP][SD]T|A[SD]T)'
+    )
+
+    def __init__(self, cache_size: int = 10_000):
+        self.cache_size = cache_size
+        self.cache: OrderedDict[str, tuple[datetime | None, str]] = OrderedDict()
+
+    def parse_entry(self, entry: dict) -> tuple[datetime | None, str, bool]:
+        """
+        Returns the date of the entry, the tier which parsed it and whether it came from the cache.
+        """
+        if published_parsed := entry.get('published_parsed'):
+            return datetime.fromtimestamp(calendar.timegm(published_parsed), timezone.utc), 'published_parsed', False
+        return self.parse(entry.get('published'))
+
+    def parse(self, raw_date: str | None) -> tuple[datetime | None, str, bool]:
+        if not raw_date:
+            return None, 'missing', False
+
+        if (cached := self.cache.get(raw_date)) is not None:
+            self.cache.move_to_end(raw_date)
+            return *cached, True
+
+        parsed = self.parse_uncached(raw_date)
+        self.cache[raw_date] = parsed
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return *parsed, False
+
+    def parse_uncached(self, raw_date: str) -> tuple[datetime | None, str]:
+        raw_date = raw_date.strip()
+
+        if self.RFC822_RE.fullmatch(raw_date):
+            try:
+                parsed_date = parsedate_to_datetime(raw_date)
+            except (TypeError, ValueError, IndexError):
+                pass
+            else:
+                # A -0000 offset means UTC without a known local zone, dateparser reads it as UTC too
+                return parsed_date if parsed_date.tzinfo else parsed_date.replace(tzinfo=timezone.utc), 'rfc822'
+
+        try:
+            return datetime.fromisoformat(raw_date), 'iso8601'
+        except ValueError:
+            pass
+
+        if parsed_date := dateparser.parse(raw_date):
+            return parsed_date, 'dateparser'
+        return None, 'unparsed'
+
+
+feed_date_parser = FeedDateParser()
@@ -0,0 +1,282 @@
+import hashlib
+import math
+import re
+import sys
+from datetime import datetime, timezone
+from typing import Iterable
+from urllib.parse import urlsplit
+
+from scrapy import Request
+from scrapy.utils.request import fingerprint
+
+# Query parameters which only track where the reader came from, e.g. ?smid=nytcore-ios-share
+TRACKING_PARAMS = frozenset({
+    'smid', 'smtyp', 'partner', 'emc', 'ref', 'referer', 'referrer', 'src', 'campaign_id', 'instance_id',
+    'segment_id', 'user_id', 'regi_id', 'nl', 'fbclid', 'gclid', 'dclid', 'msclkid', 'igshid', 'mc_cid', 'mc_eid',
+    '_ga', '_gl', 'cmpid', 'ocid', 'ito',
+})
+TRACKING_PARAM_PREFIXES = ('utm_',)
+
+_TOKEN_RE = re.compile(r'\w+')
+_TAG_RE = re.compile(r'<[^>]+>')
+_UINT64_MASK = (1 << 64) - 1
+
+
+def canonical_url(url: str) -> str:
+    """
+    The URL with the scheme (https), host and trailing slash normalized, the default port, the fragment and the
+    tracking parameters removed and the remaining parameters sorted.
+    """
+    parts = urlsplit(url.strip())
+
+    scheme = parts.scheme.lower()
+    if scheme == 'http':
+        scheme = 'https'
+
+    netloc = parts.netloc.lower()
+    if netloc.endswith((':80', ':443')):
+        netloc = netloc.rpartition(':')[0]
+    netloc = netloc.rstrip('.')
+
+    path = parts.path.rstrip('/') or '/'
+
+    query = ''
+    if parts.query:
+        params = [
+            param for param in parts.query.split('&')
+            if param and (name := param.partition('=')[0].lower()) not in TRACKING_PARAMS
+            and not name.startswith(TRACKING_PARAM_PREFIXES)
+        ]
+        if params:
+            query = '?' + '&'.join(sorted(params))
+
+    return f'{scheme}://{netloc}{path}{query}'
+
+
+def canonical_news_hash(url: str) -> str:
+    return hashlib.sha1(canonical_url(url).encode('utf-8')).hexdigest()
+
+
+def fingerprint_news_hash(url: str) -> str:
+    """
+    The news_hash of the articles stored before canonical hashing, the request fingerprint of the raw URL.
+    """
+    return fingerprint(Request(url)).hex()
+
+
+def news_hashes(url: str, mode: str) -> tuple[str, str | None]:
+    """
+    Returns the news_hash of an article URL and the legacy hash to also look up, depending on NEWS_HASH_MODE:
+        - canonical: the SHA1 of the canonical URL, no legacy hash
+        - compat: the canonical hash, plus the fingerprint hash for the articles stored before the migration
+        - fingerprint: the fingerprint hash only, as before
+    """
+    if mode == 'canonical':
+        return canonical_news_hash(url), None
+    if mode == 'compat':
+        return canonical_news_hash(url), fingerprint_news_hash(url)
+    if mode == 'fingerprint':
+        return fingerprint_news_hash(url), None
+    raise ValueError(f'Unknown news hash mode: {mode}')
+
+
+class NewsHashIndex:
+    """
+    Exact in-memory index of the news_hash values already stored in the database.
+
+    Only articles created at or after `since` (a UTC timestamp) are preloaded, so the index can only answer
+    for those. Older or undated articles are not covered and must be checked against the database.
+    """
+
+    exact = True
+
+    def __init__(self, since: int = None):
+        self.since = since
+        self.hashes: set[bytes] = set()
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def __contains__(self, news_hash: str) -> bool:
+        return bytes.fromhex(news_hash) in self.hashes
+
+    def add(self, news_hash: str) -> None:
+        self.hashes.add(bytes.fromhex(news_hash))
+
+    def update(self, news_hashes: Iterable[str]) -> None:
+        for news_hash in news_hashes:
+            self.add(news_hash)
+
+    def covers(self, created_at: int | None) -> bool:
+        if self.since is None:
+            return True
+        return created_at is not None and created_at >= self.since
+
+    @property
+    def since_datetime(self) -> datetime | None:
+        return datetime.fromtimestamp(self.since, timezone.utc) if self.since is not None else None
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self.hashes) + sum(sys.getsizeof(news_hash) for news_hash in self.hashes)
+
+
+class BloomNewsHashIndex(NewsHashIndex):
+    """
+    Bloom filter over the news_hash values, a positive answer may be a false positive and has to be confirmed
+    against the database.
+
+    The news hashes are SHA1 hex digests, so the bit positions are derived from the digest itself with double
+    hashing instead of hashing it again.
+    """
+
+    exact = False
+
+    def __init__(self, capacity: int, error_rate: float, since: int = None):
+        super().__init__(since)
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.bit_count = max(int(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(round(self.bit_count / self.capacity * math.log(2)), 1)
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, news_hash: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(news_hash))
+
+    def add(self, news_hash: str) -> None:
+        for position in self._positions(news_hash):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def _positions(self, news_hash: str) -> Iterable[int]:
+        digest = int(news_hash, 16)
+        first_hash = digest & 0xFFFFFFFFFFFFFFFF
+        second_hash = (digest >> 64) & 0xFFFFFFFFFFFFFFFF | 1
+        return ((first_hash + i * second_hash) % self.bit_count for i in range(self.hash_count))
+
+    def expected_error_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.count / self.bit_count)) ** self.hash_count
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self.bits)
+
+
+def simhash(tokens: list[str], shingle_size: int) -> int:
+    """
+    64-bit SimHash of the word shingles of `tokens`: bit i is set when it is set in most of the shingle hashes.
+    """
+    shingles = {' '.join(tokens[i:i + shingle_size]) for i in range(max(len(tokens) - shingle_size + 1, 1))}
+
+    # The per-bit counters are kept as bit planes (plane k holds bit k of every counter), adding a shingle hash
+    # is a short ripple carry over the planes instead of 64 increments
+    planes: list[int] = []
+    for shingle in shingles:
+        carry = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        k = 0
+        while carry:
+            if k == len(planes):
+                planes.append(0)
+            planes[k], carry = planes[k] ^ carry, planes[k] & carry
+            k += 1
+
+    result = 0
+    for bit in range(64):
+        count = sum(((plane >> bit) & 1) << k for k, plane in enumerate(planes))
+        if count * 2 > len(shingles):
+            result |= 1 << bit
+    return result
+
+
+def to_signed64(value: int) -> int:
+    # The SimHashes are stored in signed BIGINT columns
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def from_signed64(value: int) -> int:
+    return value & _UINT64_MASK
+
+
+class SimHasher:
+    """
+    Computes the SimHashes of the articles, run through the CPU executor.
+    """
+
+    def title_simhash(self, title: str | None, shingle_size: int, min_tokens: int) -> int | None:
+        """
+        Returns None for titles shorter than `min_tokens` words, too short to tell stories apart.
+        """
+        tokens = _TOKEN_RE.findall((title or '').lower())
+        if len(tokens) < min_tokens:
+            return None
+        return simhash(tokens, shingle_size)
+
+    def content_simhash(self, title: str | None, content: str | None, chars: int, shingle_size: int) -> int | None:
+        text = _TAG_RE.sub(' ', f'{title or ""} {content or ""}')[:chars]
+        if not (tokens := _TOKEN_RE.findall(text.lower())):
+            return None
+        return simhash(tokens, shingle_size)
+
+
+class SimHashIndex:
+    """
+    Finds a stored SimHash within `max_distance` bits of a new one.
+
+    The 64 bits are split into max_distance + 1 bands, two hashes within the distance are equal in at least one band,
+    so only the hashes sharing a band are compared. Those which turn out to be farther apart are collisions.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        band_count = max_distance + 1
+        widths = [64 // band_count + (i < 64 % band_count) for i in range(band_count)]
+        self.bands = [(sum(widths[:i]), (1 << width) - 1) for i, width in enumerate(widths)]
+        self.tables: list[dict[int, list[tuple[int, str]]]] = [{} for _ in self.bands]
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, value: int, news_hash: str) -> None:
+        for (shift, mask), table in zip(self.bands, self.tables):
+            table.setdefault((value >> shift) & mask, []).append((value, news_hash))
+        self.count += 1
+
+    def find(self, value: int) -> tuple[str | None, int]:
+        """
+        Returns the news_hash of a near duplicate (or None) and the number of collisions met on the way.
+        """
+        collisions = 0
+        compared = set()
+        for (shift, mask), table in zip(self.bands, self.tables):
+            for other_value, news_hash in table.get((value >> shift) & mask, ()):
+                if other_value in compared:
+                    continue
+                compared.add(other_value)
+
+                if (value ^ other_value).bit_count() <= self.max_distance:
+                    return news_hash, collisions
+                collisions += 1
+        return None, collisions
+
+
+class NearDuplicateIndex:
+    """
+    SimHash indexes of the recent articles: of the titles, checked before an article is requested, and of the title
+    plus the beginning of the content, checked before it is stored.
+    """
+
+    def __init__(self, title_max_distance: int, content_max_distance: int, title_shingle_size: int = 1,
+                 title_min_tokens: int = 6, content_shingle_size: int = 3, content_chars: int = 2000):
+        self.titles = SimHashIndex(title_max_distance)
+        self.contents = SimHashIndex(content_max_distance)
+        self.title_shingle_size = title_shingle_size
+        self.title_min_tokens = title_min_tokens
+        self.content_shingle_size = content_shingle_size
+        self.content_chars = content_chars
+        self.hasher = SimHasher()
+
+    def title_simhash(self, title: str | None) -> int | None:
+        return self.hasher.title_simhash(title, self.title_shingle_size, self.title_min_tokens)
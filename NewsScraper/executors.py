@@ -0,0 +1,104 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+
+from scrapy import signals
+from scrapy.crawler import Crawler
+from scrapy.statscollectors import StatsCollector
+
+from NewsScraper.utils import domain_resolver
+
+# Instances kept warm by the current process, in the workers as well as in the main process when running inline
+_instances: dict[type, Any] = {}
+
+
+def _get_instance(cls: type) -> Any:
+    if (instance := _instances.get(cls)) is None:
+        instance = _instances[cls] = cls()
+    return instance
+
+
+def _call_in_worker(cls: type, method_name: str, args: tuple) -> tuple[Any, float, dict[str, int]]:
+    started = time.perf_counter()
+    result = getattr(_get_instance(cls), method_name)(*args)
+    return result, time.perf_counter() - started, _pop_process_stats()
+
+
+def _pop_process_stats() -> dict[str, int]:
+    # Counters kept by the current process, the workers send theirs back with every result
+    return domain_resolver.pop_stats()
+
+
+class CpuBoundExecutor:
+    """
+    Runs CPU-bound calls (article parsing, content sanitizing) in a process pool, so they do not block the reactor.
+
+    Enabled with CPU_EXECUTOR_WORKERS > 0, otherwise the calls run inline. A call is given as a class, a method name and
+    arguments; the class is instantiated once per worker and kept warm. Only the arguments and the result cross the
+    process boundary, so they should be plain strings and dicts. Counters kept by the process that ran the call (e.g.
+    the domain resolver cache hits) are added to the crawler stats after every call.
+    """
+
+    def __init__(self, workers: int, stats: StatsCollector):
+        self.workers = workers
+        self.stats = stats
+        self.pool: ProcessPoolExecutor = None
+        self.queue_depth = 0
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        global executor
+        executor = cls(crawler.settings.getint('CPU_EXECUTOR_WORKERS'), crawler.stats)
+        crawler.signals.connect(executor.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(executor.spider_closed, signal=signals.spider_closed)
+        return executor
+
+    def spider_opened(self, spider):
+        if self.workers > 0:
+            # Forking a process with a running reactor is unsafe, the workers are started fresh instead
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            self.stats.set_value('cpu_executor/workers', self.workers)
+
+    def spider_closed(self, spider):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    async def run(self, cls: type, method_name: str, *args) -> Any:
+        if self.pool is None:
+            result = getattr(_get_instance(cls), method_name)(*args)
+            self.inc_process_stats(_pop_process_stats())
+            return result
+
+        self.queue_depth += 1
+        self.stats.max_value('cpu_executor/max_queue_depth', self.queue_depth)
+        try:
+            result, worker_time, process_stats = await asyncio.wrap_future(
+                self.pool.submit(_call_in_worker, cls, method_name, args)
+            )
+        finally:
+            self.queue_depth -= 1
+
+        self.inc_process_stats(process_stats)
+        self.stats.inc_value('cpu_executor/tasks')
+        self.stats.inc_value('cpu_executor/worker_time', worker_time)
+        self.stats.inc_value(f'cpu_executor/worker_time/{cls.__name__}.{method_name}', worker_time)
+        return result
+
+    def inc_process_stats(self, process_stats: dict[str, int]) -> None:
+        for key, value in process_stats.items():
+            self.stats.inc_value(key, value)
+
+
+executor: CpuBoundExecutor = None
+
+
+async def run(cls: type, method_name: str, *args) -> Any:
+    """
+    Calls `method_name` of a warm `cls` instance, in the process pool when it is enabled.
+    """
+    if executor is None:
+        return getattr(_get_instance(cls), method_name)(*args)
+    return await executor.run(cls, method_name, *args)
@@ -0,0 +1,147 @@
+import random
+import time
+from collections import defaultdict
+
+from scrapy import signals, Request
+from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Response
+from twisted.internet.task import LoopingCall
+
+
+class LatencySamples:
+    """
+    Count, total and maximum of a stage's latencies, plus a uniform reservoir sample of them for the percentiles.
+    """
+
+    __slots__ = ('count', 'total', 'maximum', 'samples', 'size')
+
+    def __init__(self, size: int):
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.samples: list[float] = []
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+        if len(self.samples) < self.size:
+            self.samples.append(seconds)
+        elif (index := random.randrange(self.count)) < self.size:
+            self.samples[index] = seconds
+
+    def percentile(self, percent: float) -> float:
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
+
+
+class StageLatencyExtension:
+    """
+    Records how long every request and item spends in each stage of a run:
+        - scheduler: from being scheduled to reaching the downloader
+        - download/<route>: in the downloader, slot delay included (route is zyte_api, proxy or direct)
+        - injection: from the response to the spider callback (page object injection, spider middlewares)
+        - parse_articles, to_item: the spider callbacks, recorded by the spider
+        - default_pipeline, mysql_queue, mysql_write: recorded by the pipelines
+
+    Every STAGE_LATENCY_INTERVAL seconds and when the spider closes the count, mean, p50, p95, p99 and max of each
+    stage (in milliseconds) are written to the stats under stage_latency/<stage>/, which PeriodicLog logs. Samples
+    above the stage's STAGE_LATENCY_SLOW_THRESHOLDS (seconds) are counted in stage_latency/<stage>/slow right away.
+    """
+
+    def __init__(self, crawler: Crawler, interval: float, slow_thresholds: dict[str, float], reservoir_size: int):
+        self.stats = crawler.stats
+        self.interval = interval
+        self.slow_thresholds = slow_thresholds
+        self.stages: dict[str, LatencySamples] = defaultdict(lambda: LatencySamples(reservoir_size))
+        self.report_loop: LoopingCall = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        if not crawler.settings.getbool('STAGE_LATENCY_ENABLED'):
+            raise NotConfigured
+
+        global stage_latency
+        stage_latency = cls(
+            crawler,
+            crawler.settings.getfloat('STAGE_LATENCY_INTERVAL'),
+            crawler.settings.getdict('STAGE_LATENCY_SLOW_THRESHOLDS'),
+            crawler.settings.getint('STAGE_LATENCY_RESERVOIR_SIZE'),
+        )
+        crawler.signals.connect(stage_latency.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(stage_latency.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(stage_latency.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(stage_latency.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(stage_latency.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(stage_latency.response_received, signal=signals.response_received)
+        return stage_latency
+
+    def spider_opened(self, spider):
+        if self.interval > 0:
+            self.report_loop = LoopingCall(self.report)
+            self.report_loop.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.report_loop and self.report_loop.running:
+            self.report_loop.stop()
+        self.report()
+
+    def request_scheduled(self, request: Request, spider):
+        request.meta['stage_latency_scheduled'] = time.perf_counter()
+
+    def request_reached_downloader(self, request: Request, spider):
+        now = request.meta['stage_latency_downloading'] = time.perf_counter()
+        if (scheduled := request.meta.get('stage_latency_scheduled')) is not None:
+            self.record('scheduler', now - scheduled)
+
+    def response_downloaded(self, response: Response, request: Request, spider):
+        if (downloading := request.meta.get('stage_latency_downloading')) is None:
+            return
+
+        slot = request.meta.get('download_slot') or ''
+        if slot.startswith('zyte-api@'):
+            route = 'zyte_api'
+        elif request.meta.get('proxy'):
+            route = 'proxy'
+        else:
+            route = 'direct'
+        self.record(f'download/{route}', time.perf_counter() - downloading)
+
+    def response_received(self, response: Response, request: Request, spider):
+        request.meta['stage_latency_received'] = time.perf_counter()
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.stages[stage].add(seconds)
+        if (slow_threshold := self.slow_thresholds.get(stage)) is not None and seconds > slow_threshold:
+            self.stats.inc_value(f'stage_latency/{stage}/slow')
+
+    def report(self) -> None:
+        for stage, latencies in self.stages.items():
+            if not latencies.count:
+                continue
+
+            prefix = f'stage_latency/{stage}'
+            self.stats.set_value(f'{prefix}/count', latencies.count)
+            self.stats.set_value(f'{prefix}/mean_ms', round(latencies.total / latencies.count * 1000, 1))
+            for percent in (50, 95, 99):
+                self.stats.set_value(f'{prefix}/p{percent}_ms', round(latencies.percentile(percent) * 1000, 1))
+            self.stats.set_value(f'{prefix}/max_ms', round(latencies.maximum * 1000, 1))
+
+
+stage_latency: StageLatencyExtension = None
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    """
+    Records a stage timed outside of the extension (the spider callbacks, the pipelines), a no-op when it is disabled.
+    """
+    if stage_latency is not None:
+        stage_latency.record(stage, seconds)
+
+
+def record_stage_since(stage: str, request_meta: dict, meta_key: str = 'stage_latency_received') -> None:
+    if stage_latency is not None and (started := request_meta.get(meta_key)) is not None:
+        stage_latency.record(stage, time.perf_counter() - started)
@@ -0,0 +1,116 @@
+import abc
+import io
+from typing import Iterator
+
+import feedparser
+from lxml import etree
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+RSS1_NS = '{http://purl.org/rss/1.0/}'
+DC_NS = '{http://purl.org/dc/elements/1.1/}'
+MEDIA_NS = '{http://search.yahoo.com/mrss/}'
+
+ENTRY_TAGS = ('item', f'{RSS1_NS}item', f'{ATOM_NS}entry')
+
+
+class FeedEngine(abc.ABC):
+    """
+    Yields the entries of an RSS or Atom feed as feedparser-like dicts with just the fields the scraper uses:
+    link, title, published and media_content.
+    """
+
+    name: str = None
+
+    @abc.abstractmethod
+    def iter_entries(self, body: bytes) -> Iterator[dict]:
+        ...
+
+
+class FeedparserFeedEngine(FeedEngine):
+    name = 'feedparser'
+
+    def iter_entries(self, body: bytes) -> Iterator[dict]:
+        yield from feedparser.parse(body)['entries']
+
+
+class StreamingFeedEngine(FeedEngine):
+    """
+    Parses the raw feed bytes incrementally with lxml's iterparse, yielding every entry as soon as its closing tag
+    is read and clearing it right after, so the memory stays flat however long the feed is and nothing is parsed
+    past the last entry the caller asks for.
+
+    Malformed feeds (e.g. undeclared HTML entities) are handed over to feedparser, skipping the entries which were
+    already yielded.
+    """
+
+    name = 'streaming'
+
+    def __init__(self, fallback: FeedEngine = None):
+        self.fallback = fallback or FeedparserFeedEngine()
+        self.fallbacks = 0
+
+    def iter_entries(self, body: bytes) -> Iterator[dict]:
+        yielded = 0
+        try:
+            for _, element in etree.iterparse(io.BytesIO(body), events=('end',), tag=ENTRY_TAGS,
+                                              resolve_entities=False, no_network=True):
+                entry = self.parse_entry(element)
+
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+                yielded += 1
+                yield entry
+
+        except etree.XMLSyntaxError:
+            self.fallbacks += 1
+            for index, entry in enumerate(self.fallback.iter_entries(body)):
+                if index >= yielded:
+                    yield entry
+
+    def parse_entry(self, element: etree.ElementBase) -> dict:
+        if element.tag == f'{ATOM_NS}entry':
+            return {
+                'link': self.atom_link(element),
+                'title': self.child_text(element, f'{ATOM_NS}title'),
+                'published': self.child_text(element, f'{ATOM_NS}published', f'{ATOM_NS}updated'),
+                'media_content': self.media_content(element),
+            }
+
+        namespace = RSS1_NS if element.tag == f'{RSS1_NS}item' else ''
+        link = self.child_text(element, f'{namespace}link')
+        if not link and (guid := element.find(f'{namespace}guid')) is not None:
+            if guid.get('isPermaLink', 'true') != 'false':
+                link = (guid.text or '').strip() or None
+
+        return {
+            'link': link,
+            'title': self.child_text(element, f'{namespace}title'),
+            'published': self.child_text(element, f'{namespace}pubDate', f'{DC_NS}date'),
+            'media_content': self.media_content(element),
+        }
+
+    @staticmethod
+    def child_text(element: etree.ElementBase, *tags: str) -> str | None:
+        for tag in tags:
+            if (child := element.find(tag)) is not None and child.text:
+                return child.text.strip()
+        return None
+
+    @staticmethod
+    def atom_link(element: etree.ElementBase) -> str | None:
+        for link in element.iterfind(f'{ATOM_NS}link'):
+            if link.get('rel', 'alternate') == 'alternate' and link.get('href'):
+                return link.get('href').strip()
+        return None
+
+    @staticmethod
+    def media_content(element: etree.ElementBase) -> list[dict]:
+        return [dict(media.attrib) for media in element.iter(f'{MEDIA_NS}content')]
+
+
+FEED_ENGINES = {
+    'streaming': StreamingFeedEngine,
+    'feedparser': FeedparserFeedEngine,
+}
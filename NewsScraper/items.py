@@ -18,3 +18,8 @@ class ArticleItem(scrapy.Item):
     featured_image = scrapy.Field()
 
     news_hash = scrapy.Field()
+    # Hash of the article stored before the canonical hashing, only looked up (NEWS_HASH_MODE = "compat")
+    legacy_news_hash = scrapy.Field()
+    source_id = scrapy.Field()
+    title_simhash = scrapy.Field()
+    content_simhash = scrapy.Field()
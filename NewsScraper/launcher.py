@@ -0,0 +1,66 @@
+"""
+Starts N sharded workers of a spider on this machine, each one a separate `scrapy crawl` process.
+
+    python -m NewsScraper.launcher --workers 4
+    python -m NewsScraper.launcher --workers 4 --mode modulo --log-dir logs
+    python -m NewsScraper.launcher --workers 2 -s MYSQL_CONNECTION_STRING=sqlite:///news.db
+
+Ctrl+C (SIGINT) and SIGTERM are passed on to the workers, which shut down gracefully and release their leases. The
+exit code is the highest exit code of the workers.
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+from pathlib import Path
+
+
+def worker_command(args: argparse.Namespace, index: int) -> list[str]:
+    settings = {
+        'SHARDING_MODE': args.mode,
+        'SHARD_INDEX': index,
+        'SHARD_COUNT': args.workers,
+        'SHARD_WORKER_ID': f'{socket.gethostname()}:{os.getpid()}:{index}',
+    }
+    if args.log_dir:
+        settings['LOG_FILE'] = Path(args.log_dir) / f'worker-{index}.log'
+
+    command = [sys.executable, '-m', 'scrapy', 'crawl', args.spider]
+    for name, value in settings.items():
+        command += ['-s', f'{name}={value}']
+    for setting in args.set:
+        command += ['-s', setting]
+    return command
+
+
+def main(args: argparse.Namespace) -> int:
+    if args.log_dir:
+        Path(args.log_dir).mkdir(parents=True, exist_ok=True)
+
+    workers = [subprocess.Popen(worker_command(args, index)) for index in range(args.workers)]
+
+    def forward_signal(signum, _):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signum)
+
+    signal.signal(signal.SIGINT, forward_signal)
+    signal.signal(signal.SIGTERM, forward_signal)
+
+    exit_codes = [worker.wait() for worker in workers]
+    for index, exit_code in enumerate(exit_codes):
+        print(f'worker {index}: exit code {exit_code}')
+    return max(exit_codes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--mode', choices=['lease', 'modulo'], default='lease')
+    parser.add_argument('--spider', default='news_spider')
+    parser.add_argument('--log-dir', help='write the log of every worker to <log-dir>/worker-<index>.log')
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='a setting passed on to every worker, repeatable')
+    sys.exit(main(parser.parse_args()))
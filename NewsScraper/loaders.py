@@ -1,8 +1,6 @@
 from itemloaders import ItemLoader
 from itemloaders.processors import TakeFirst
-from scrapy import Request
-from scrapy.utils.request import fingerprint
-
+from NewsScraper.dedup import news_hashes
 from NewsScraper.items import ArticleItem
 
 
@@ -14,8 +12,10 @@ class ArticleItemLoader(ItemLoader):
 
     def load_item(self) -> ArticleItem:
         if source_url := self.get_output_value('source_url'):
-            request_hash = fingerprint(Request(source_url)).hex()
-            self.replace_value('news_hash', request_hash)
+            news_hash, legacy_news_hash = news_hashes(source_url, self.context.get('news_hash_mode', 'compat'))
+            self.replace_value('news_hash', news_hash)
+            if legacy_news_hash:
+                self.replace_value('legacy_news_hash', legacy_news_hash)
 
         if created_at := self.get_output_value('created_at'):
             # TODO: check if it is already a timestamp
@@ -2,9 +2,17 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+import time
 from uuid import uuid4
 
-from scrapy import signals
+from scrapy import signals, Request
+from scrapy.core.downloader import Slot
+from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured, IgnoreRequest
+from scrapy.http import Response
+from scrapy.utils.httpobj import urlparse_cached
+
+from NewsScraper.archive import ResponseArchive, archive_key
 
 
 # useful for handling different item types with a single interface
@@ -22,6 +30,231 @@ class ProxyMiddleware:
             request.meta['proxy'] = _proxy.format(request.meta.get('cookiejar') or uuid4().hex)
 
 
+class SlotState:
+    __slots__ = ('route', 'concurrency', 'delay', 'latency', 'error_rate', 'limits')
+
+    def __init__(self, route: str, concurrency: float, delay: float, limits: dict):
+        self.route = route
+        self.limits = limits
+        self.concurrency = min(max(concurrency, limits['min_concurrency']), limits['max_concurrency'])
+        self.delay = min(max(delay, limits['min_delay']), limits['max_delay'])
+        self.latency: float = None
+        self.error_rate = 0.0
+
+
+class AdaptiveSlotMiddleware:
+    """
+    Tunes the concurrency and the delay of every downloader slot from what its responses look like, instead of the
+    fixed CONCURRENT_REQUESTS_PER_DOMAIN and DOWNLOAD_DELAY.
+
+    A slot is a host and a route: "zyte_api" (slotted as zyte-api@host by scrapy-zyte-api), "proxy" or "direct".
+    The slot is worked out again from the URL of every request, retries and redirects (which keep the meta of the
+    original request) included.
+    Every route has its own floors and ceilings in ADAPTIVE_SLOTS_LIMITS. A 429, a 5xx or a download error halves
+    the concurrency and doubles the delay, a fast and healthy slot gets one more concurrent request per window
+    of `concurrency` responses and a shorter delay, a slow slot gives concurrency back the same way.
+    """
+
+    EWMA_WEIGHT = 0.2
+
+    def __init__(self, crawler: Crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.limits = crawler.settings.getdict('ADAPTIVE_SLOTS_LIMITS')
+        self.target_latency = crawler.settings.getfloat('ADAPTIVE_SLOTS_TARGET_LATENCY')
+        self.error_threshold = crawler.settings.getfloat('ADAPTIVE_SLOTS_ERROR_THRESHOLD')
+        self.initial_concurrency = crawler.settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')
+        self.initial_delay = crawler.settings.getfloat('DOWNLOAD_DELAY')
+        self.slot_states: dict[str, SlotState] = {}
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        if not crawler.settings.getbool('ADAPTIVE_SLOTS_ENABLED'):
+            raise NotConfigured
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def process_request(self, request: Request, spider):
+        downloader = self.crawler.engine.downloader
+        hostname = urlparse_cached(request).hostname or ''
+
+        if (request.meta.get('download_slot') or '').startswith('zyte-api@'):
+            route, slot_key = 'zyte_api', f'zyte-api@{hostname}'
+        elif request.meta.get('proxy'):
+            route, slot_key = 'proxy', f'proxy@{hostname}'
+        else:
+            route, slot_key = 'direct', hostname
+        request.meta['download_slot'] = slot_key
+
+        if (slot_state := self.slot_states.get(slot_key)) is None:
+            slot_state = self.slot_states[slot_key] = SlotState(
+                route, self.initial_concurrency, self.initial_delay, self.limits[route]
+            )
+
+        # Idle slots are garbage collected by the downloader, they come back with the last tuned values
+        if slot_key not in downloader.slots:
+            downloader.slots[slot_key] = Slot(int(slot_state.concurrency), slot_state.delay, downloader.randomize_delay)
+
+        request.meta['adaptive_slot'] = slot_key
+        request.meta['adaptive_slot_started'] = time.monotonic()
+
+    def process_response(self, request: Request, response: Response, spider):
+        throttled = response.status == 429 or response.status >= 500
+        self.adjust(request, throttled)
+        return response
+
+    def process_exception(self, request: Request, exception: Exception, spider):
+        self.adjust(request, True)
+
+    def adjust(self, request: Request, throttled: bool) -> None:
+        if (slot_state := self.slot_states.get(request.meta.get('adaptive_slot'))) is None:
+            return
+
+        limits = slot_state.limits
+        latency = request.meta.get('download_latency') or time.monotonic() - request.meta['adaptive_slot_started']
+        slot_state.latency = latency if slot_state.latency is None else (
+            self.EWMA_WEIGHT * latency + (1 - self.EWMA_WEIGHT) * slot_state.latency
+        )
+        slot_state.error_rate = self.EWMA_WEIGHT * throttled + (1 - self.EWMA_WEIGHT) * slot_state.error_rate
+
+        route = slot_state.route
+        if throttled:
+            slot_state.concurrency = max(slot_state.concurrency / 2, limits['min_concurrency'])
+            slot_state.delay = min(max(slot_state.delay * 2, limits['min_delay'], 0.5), limits['max_delay'])
+            self.stats.inc_value(f'adaptive_slots/{route}/backoffs')
+
+        elif slot_state.error_rate < self.error_threshold and slot_state.latency <= self.target_latency:
+            slot_state.concurrency = min(slot_state.concurrency + 1 / slot_state.concurrency, limits['max_concurrency'])
+            slot_state.delay = max(slot_state.delay * 0.9, limits['min_delay'])
+            self.stats.inc_value(f'adaptive_slots/{route}/speedups')
+
+        elif slot_state.latency > self.target_latency:
+            slot_state.concurrency = max(slot_state.concurrency - 1 / slot_state.concurrency, limits['min_concurrency'])
+            self.stats.inc_value(f'adaptive_slots/{route}/slowdowns')
+
+        if slot := self.crawler.engine.downloader.slots.get(request.meta['adaptive_slot']):
+            slot.concurrency = int(slot_state.concurrency)
+            slot.delay = slot_state.delay
+
+        self.stats.max_value(f'adaptive_slots/{route}/max_concurrency', int(slot_state.concurrency))
+
+    def spider_closed(self, spider):
+        for slot_key, slot_state in self.slot_states.items():
+            self.stats.set_value(f'adaptive_slots/slot/{slot_key}/concurrency', int(slot_state.concurrency))
+            self.stats.set_value(f'adaptive_slots/slot/{slot_key}/delay', round(slot_state.delay, 3))
+            if slot_state.latency is not None:
+                self.stats.set_value(f'adaptive_slots/slot/{slot_key}/latency', round(slot_state.latency, 3))
+            self.stats.set_value(f'adaptive_slots/slot/{slot_key}/error_rate', round(slot_state.error_rate, 3))
+
+
+class FreshnessMiddleware:
+    """
+    Records how old the articles are when they are fetched (article_age/* stats) and, with CRAWL_DEADLINE set,
+    drops the article requests older than CRAWL_DEADLINE_STALE_AGE once the deadline has passed. The fresh ones are
+    fetched first anyway (ARTICLE_PRIORITY_ENABLED), so what is left after the deadline is mostly stale.
+    """
+
+    AGE_BUCKETS = ((3600, '1h'), (3 * 3600, '3h'), (6 * 3600, '6h'), (12 * 3600, '12h'), (86400, '24h'),
+                   (3 * 86400, '72h'))
+
+    def __init__(self, stats, deadline: float, stale_age: float):
+        self.stats = stats
+        self.deadline = deadline
+        self.stale_age = stale_age
+        self.started: float = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        middleware = cls(
+            crawler.stats,
+            crawler.settings.getfloat('CRAWL_DEADLINE'),
+            crawler.settings.getfloat('CRAWL_DEADLINE_STALE_AGE'),
+        )
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        return middleware
+
+    def spider_opened(self, spider):
+        self.started = time.monotonic()
+
+    def process_request(self, request: Request, spider):
+        if (created_at := request.meta.get('article_created_at')) is None:
+            return
+
+        age = max(time.time() - created_at, 0)
+        if self.deadline and time.monotonic() - self.started > self.deadline and age > self.stale_age:
+            self.stats.inc_value('freshness/deadline_dropped')
+            raise IgnoreRequest(f'Stale article after the crawl deadline: {request.url}')
+
+        # Retries and redirects keep the meta of the article request, which is already counted
+        if 'retry_times' in request.meta or 'redirect_times' in request.meta:
+            return
+
+        self.stats.inc_value(f'article_age/{self.age_bucket(age)}')
+        self.stats.max_value('article_age/max_seconds', int(age))
+        self.stats.min_value('article_age/min_seconds', int(age))
+
+    def age_bucket(self, age: float) -> str:
+        for max_age, bucket in self.AGE_BUCKETS:
+            if age <= max_age:
+                return f'under_{bucket}'
+        return f'over_{self.AGE_BUCKETS[-1][1]}'
+
+
+class ResponseArchiveMiddleware:
+    """
+    Stores the successful feed and article responses in the local ResponseArchive (RESPONSE_ARCHIVE_ENABLED), and in
+    replay mode (RESPONSE_ARCHIVE_REPLAY, set by the news_replay spider) answers every request from the archive
+    without touching the network. Requests which are not archived are ignored in replay mode.
+    """
+
+    def __init__(self, archive: ResponseArchive, replay: bool, stats):
+        self.archive = archive
+        self.replay = replay
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        replay = crawler.settings.getbool('RESPONSE_ARCHIVE_REPLAY')
+        if not replay and not crawler.settings.getbool('RESPONSE_ARCHIVE_ENABLED'):
+            raise NotConfigured
+
+        archive = ResponseArchive(
+            crawler.settings.get('RESPONSE_ARCHIVE_DIR'),
+            crawler.settings.getint('RESPONSE_ARCHIVE_MAX_BYTES'),
+        )
+        return cls(archive, replay, crawler.stats)
+
+    def process_request(self, request: Request, spider):
+        if not self.replay:
+            return
+
+        if (response := self.archive.load_response(archive_key(request), request)) is None:
+            self.stats.inc_value('response_archive/replay_missing')
+            raise IgnoreRequest(f'Not in the response archive: {request.url}')
+
+        self.stats.inc_value('response_archive/replayed')
+        response.flags.append('archived')
+        return response
+
+    def process_response(self, request: Request, response: Response, spider):
+        if self.replay or response.status != 200:
+            return response
+
+        init_item = request.cb_kwargs.get('init_item')
+        stored_bytes = self.archive.store(
+            archive_key(request),
+            response,
+            kind='article' if init_item else 'feed',
+            init_item=dict(init_item) if init_item else None,
+            source=None if init_item else request.cb_kwargs.get('source'),
+        )
+        self.stats.inc_value('response_archive/stored')
+        self.stats.inc_value('response_archive/stored_bytes', stored_bytes)
+        self.stats.set_value('response_archive/total_bytes', self.archive.total_bytes)
+        return response
+
+
 class NewsscraperSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the spider middleware does not modify the
@@ -1,12 +1,35 @@
-from spidermon import MonitorSuite
+from spidermon import MonitorSuite, monitors
 from spidermon.contrib.scrapy.monitors import ErrorCountMonitor, FieldCoverageMonitor, UnwantedHTTPCodesMonitor
+from spidermon.contrib.scrapy.monitors.base import BaseScrapyMonitor
+
+
+@monitors.name('Stage latency')
+class StageLatencyMonitor(BaseScrapyMonitor):
+    """
+    Fails the run when the p95 latency of a stage (stage_latency/<stage>/p95_ms) is over its budget in
+    SPIDERMON_STAGE_LATENCY_P95_BUDGETS. Stages which did not run are not checked.
+    """
+
+    @monitors.name('Stage p95 latencies are within their budgets')
+    def test_stage_latency_budgets(self):
+        budgets = self.crawler.settings.getdict('SPIDERMON_STAGE_LATENCY_P95_BUDGETS')
+        over_budget = {
+            stage: p95
+            for stage, budget in budgets.items()
+            if (p95 := self.data.stats.get(f'stage_latency/{stage}/p95_ms')) is not None and p95 > budget
+        }
+        self.assertFalse(
+            over_budget,
+            msg=', '.join(f'{stage} p95 {p95} ms > {budgets[stage]} ms' for stage, p95 in over_budget.items()),
+        )
 
 
 class SingleErrorMonitorSuite(MonitorSuite):
     monitors = [
         ErrorCountMonitor,
         # FieldCoverageMonitor,
-        UnwantedHTTPCodesMonitor
+        UnwantedHTTPCodesMonitor,
+        StageLatencyMonitor,
     ]
 
     monitors_failed_actions = [
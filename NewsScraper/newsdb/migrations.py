@@ -0,0 +1,229 @@
+"""
+Migrations of the news database, run by hand against the database of MYSQL_CONNECTION_STRING (or the one given):
+
+    python -m NewsScraper.newsdb.migrations canonical_news_hash --dry-run
+    python -m NewsScraper.newsdb.migrations canonical_news_hash --connection-string sqlite:///news.db
+    python -m NewsScraper.newsdb.migrations compress_article_content --add-column-only
+
+New tables are created by models.init_db, the migrations add the new columns of the existing tables and rewrite the
+data.
+"""
+import argparse
+import sys
+from typing import Callable
+
+from scrapy.utils.project import get_project_settings
+from sqlalchemy import select, update, delete, bindparam, func, inspect, text
+from sqlalchemy.orm import Session as SessionType
+
+import NewsScraper.newsdb.models as models
+from NewsScraper.dedup import canonical_news_hash
+
+
+def migrate_canonical_news_hash(session: SessionType, args: argparse.Namespace) -> None:
+    """
+    Rewrites the news_hash of the articles stored with the fingerprint hash to the canonical hash of their source_url.
+
+    Articles whose URLs only differ by tracking parameters end up with the same canonical hash. An article already
+    stored with it (in "compat" mode) keeps it, otherwise the oldest one gets it; the others keep their old hash, or
+    are deleted with their media with --delete-duplicates. No article is ever rehashed onto a stored hash.
+    Once done, NEWS_HASH_MODE can be switched from "compat" to "canonical".
+    """
+    articles = models.Article.__table__
+    stored_hashes = set(session.scalars(
+        select(articles.c.news_hash).execution_options(yield_per=args.batch_size)
+    ))
+    query = (
+        select(articles.c.article_id, articles.c.news_hash, articles.c.source_url)
+        .order_by(articles.c.created_at, articles.c.article_id)
+        .execution_options(yield_per=args.batch_size)
+    )
+
+    canonical_owners: dict[str, int] = {}
+    rehashed: list[dict] = []
+    duplicate_ids: list[int] = []
+    for article_id, news_hash, source_url in session.execute(query):
+        new_hash = canonical_news_hash(source_url)
+        if new_hash == news_hash:
+            canonical_owners[new_hash] = article_id
+            continue
+
+        # Taken by a newer article stored in compat mode, or by an older one of this pass
+        if new_hash in stored_hashes or new_hash in canonical_owners:
+            duplicate_ids.append(article_id)
+            continue
+
+        canonical_owners[new_hash] = article_id
+        rehashed.append({'old_hash': news_hash, 'new_hash': new_hash})
+
+    print(f'{len(canonical_owners) + len(duplicate_ids)} articles: {len(rehashed)} to rehash, '
+          f'{len(duplicate_ids)} duplicates')
+    if args.dry_run:
+        return
+
+    if args.delete_duplicates:
+        for start in range(0, len(duplicate_ids), args.batch_size):
+            batch_ids = duplicate_ids[start:start + args.batch_size]
+            session.execute(delete(models.Media.__table__).where(models.Media.article_id.in_(batch_ids)))
+            session.execute(delete(articles).where(articles.c.article_id.in_(batch_ids)))
+            session.commit()
+
+    rehash = (
+        update(articles)
+        .where(articles.c.news_hash == bindparam('old_hash'))
+        .values(news_hash=bindparam('new_hash'))
+    )
+    for start in range(0, len(rehashed), args.batch_size):
+        session.execute(rehash, rehashed[start:start + args.batch_size])
+        session.commit()
+
+    print(f'Rehashed {len(rehashed)} articles' + (f', deleted {len(duplicate_ids)}' if args.delete_duplicates else ''))
+
+
+def has_column(session: SessionType, table_name: str, column_name: str) -> bool:
+    return column_name in {column['name'] for column in inspect(session.get_bind()).get_columns(table_name)}
+
+
+def add_column(session: SessionType, table_name: str, column_name: str, column_type: str) -> None:
+    session.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}'))
+    session.commit()
+    print(f'Added {table_name}.{column_name}')
+
+
+def migrate_article_content_digest(session: SessionType, args: argparse.Namespace) -> None:
+    """
+    Adds articles.content_digest and fills it with the article_digest of the stored articles, so the MySQLPipeline can
+    tell which re-scraped articles are unchanged. Digests filled before it covered the stored columns are refreshed.
+    """
+    if not has_column(session, 'articles', 'content_digest'):
+        if args.dry_run:
+            print('articles.content_digest is missing, every article would get a content digest')
+            return
+        add_column(session, 'articles', 'content_digest', 'VARCHAR(40) NULL')
+    if args.add_column_only:
+        return
+
+    articles = models.Article.__table__
+    # content_body is missing from the databases of the "text" storage, article_digest reads it as NULL
+    digest_columns = [articles.c[column] for column in models.DIGEST_COLUMNS if has_column(session, 'articles', column)]
+    query = (
+        select(articles.c.news_hash, articles.c.content_digest, *digest_columns)
+        .execution_options(yield_per=args.batch_size)
+    )
+    digests = []
+    for row in session.execute(query):
+        if (digest := models.article_digest(row._mapping)) != row.content_digest:
+            digests.append({'row_hash': row.news_hash, 'digest': digest})
+    print(f'{len(digests)} articles without an up to date content digest')
+    if args.dry_run:
+        return
+
+    fill_digest = (
+        update(articles)
+        .where(articles.c.news_hash == bindparam('row_hash'))
+        .values(content_digest=bindparam('digest'))
+    )
+    for start in range(0, len(digests), args.batch_size):
+        session.execute(fill_digest, digests[start:start + args.batch_size])
+        session.commit()
+    print(f'Filled the content digest of {len(digests)} articles')
+
+
+def migrate_compress_article_content(session: SessionType, args: argparse.Namespace) -> None:
+    """
+    Adds articles.content_body and moves the content of the stored articles into it compressed, for
+    ARTICLE_CONTENT_STORAGE = "compressed". The rows are moved in batches of --batch-size, in news_hash order.
+    With --add-column-only the content stays where it is, the column can be added before the workers are upgraded and
+    the rows moved later.
+    """
+    articles = models.Article.__table__
+    if not has_column(session, 'articles', 'content_body'):
+        if args.dry_run:
+            print('articles.content_body is missing, every article would be compressed')
+            return
+        dialect = session.get_bind().dialect
+        add_column(session, 'articles', 'content_body',
+                   articles.c.content_body.type.load_dialect_impl(dialect).compile(dialect=dialect))
+    if args.add_column_only:
+        return
+
+    remaining = session.scalar(select(func.count()).select_from(articles).where(articles.c.content != ''))
+    print(f'{remaining} articles with uncompressed content')
+    if args.dry_run:
+        return
+
+    compress = (
+        update(articles)
+        .where(articles.c.news_hash == bindparam('row_hash'))
+        .values(content_body=bindparam('body'), content='')
+    )
+    moved = 0
+    last_hash = ''
+    while rows := session.execute(
+        select(articles.c.news_hash, articles.c.content)
+        .where(articles.c.content != '', articles.c.news_hash > last_hash)
+        .order_by(articles.c.news_hash)
+        .limit(args.batch_size)
+    ).all():
+        session.execute(compress, [{'row_hash': news_hash, 'body': content} for news_hash, content in rows])
+        session.commit()
+        moved += len(rows)
+        last_hash = rows[-1][0]
+    print(f'Compressed the content of {moved} articles')
+
+
+def migrate_media_unique_url(session: SessionType, args: argparse.Namespace) -> None:
+    """
+    Deletes the duplicate media of an article (same media_url, the oldest row is kept) and adds the unique key on
+    (article_id, media_url) the MySQLPipeline upserts media on.
+    """
+    media = models.Media.__table__
+    if 'uq_media_article_url' in models.unique_key_names(inspect(session.get_bind()), 'media'):
+        print('media already has the uq_media_article_url key')
+        return
+
+    kept_ids = select(func.min(media.c.media_id)).group_by(media.c.article_id, media.c.media_url)
+    duplicates = session.scalar(
+        select(func.count()).select_from(media).where(media.c.media_id.not_in(kept_ids.scalar_subquery()))
+    )
+    print(f'{duplicates} duplicate media')
+    if args.dry_run:
+        return
+
+    # MySQL cannot delete from a table it selects from in a subquery, the kept ids are read first
+    kept_ids = set(session.scalars(kept_ids))
+    duplicate_ids = [media_id for media_id in session.scalars(select(media.c.media_id)) if media_id not in kept_ids]
+    for start in range(0, len(duplicate_ids), args.batch_size):
+        session.execute(delete(media).where(media.c.media_id.in_(duplicate_ids[start:start + args.batch_size])))
+        session.commit()
+
+    session.execute(text('CREATE UNIQUE INDEX uq_media_article_url ON media (article_id, media_url)'))
+    session.commit()
+    print(f'Deleted {len(duplicate_ids)} duplicate media, added uq_media_article_url')
+
+
+MIGRATIONS: dict[str, Callable[[SessionType, argparse.Namespace], None]] = {
+    'canonical_news_hash': migrate_canonical_news_hash,
+    'article_content_digest': migrate_article_content_digest,
+    'compress_article_content': migrate_compress_article_content,
+    'media_unique_url': migrate_media_unique_url,
+}
+
+
+def main(args: argparse.Namespace) -> int:
+    models.init_db(args.connection_string or get_project_settings().get('MYSQL_CONNECTION_STRING'))
+    with models.Session() as session:
+        MIGRATIONS[args.migration](session, args)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('migration', choices=list(MIGRATIONS))
+    parser.add_argument('--connection-string', help='defaults to MYSQL_CONNECTION_STRING of the project settings')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true', help='only count the rows which would change')
+    parser.add_argument('--delete-duplicates', action='store_true')
+    parser.add_argument('--add-column-only', action='store_true',
+                        help='only add the missing column, the rows are migrated by a later run')
+    sys.exit(main(parser.parse_args()))
@@ -1,10 +1,65 @@
-from datetime import datetime
-
-from sqlalchemy import Column, Integer, String, Text, Enum, ForeignKey, Boolean, DateTime, TIMESTAMP, create_engine
+import hashlib
+import logging
+import zlib
+from datetime import datetime, timezone
+from typing import Iterable, Mapping
+
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Enum, ForeignKey, Boolean, DateTime, TIMESTAMP, Table, create_engine
+from sqlalchemy import UniqueConstraint
+from sqlalchemy import LargeBinary, TypeDecorator, Engine, inspect, select, func
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import relationship, declarative_base, Session as SessionType, sessionmaker, scoped_session
+from sqlalchemy.sql import Insert
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Bumped whenever a table or column is added, see check_schema_version
+SCHEMA_VERSION = 1
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class CompressedText(TypeDecorator):
+    """
+    A str stored compressed in a binary column (MEDIUMBLOB on MySQL, up to 16 MiB), with zstd when zstandard is
+    installed and zlib otherwise. Reading tells the two apart by the zstd magic number, so rows written with either
+    can be read back; the zstd ones need zstandard.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'mysql':
+            return dialect.type_descriptor(mysql.MEDIUMBLOB())
+        return dialect.type_descriptor(LargeBinary())
+
+    def process_bind_param(self, value: str | None, dialect) -> bytes | None:
+        if value is None:
+            return None
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=3).compress(value.encode('utf-8'))
+        return zlib.compress(value.encode('utf-8'), 3)
+
+    def process_result_value(self, value: bytes | None, dialect) -> str | None:
+        if value is None:
+            return None
+        if value.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise RuntimeError('The content was compressed with zstd, reading it needs zstandard '
+                                   '(pip install zstandard)')
+            return zstandard.ZstdDecompressor().decompress(value).decode('utf-8')
+        return zlib.decompress(value).decode('utf-8')
+
 
 class BaseMixin(Base):
     __abstract__ = True
@@ -38,6 +93,41 @@ class ScraperSource(BaseMixin):
 
     # Relationship
     category = relationship("Category", back_populates="sources")
+    state = relationship("ScraperSourceState", back_populates="source", uselist=False)
+
+
+class ScraperSourceState(BaseMixin):
+    """
+    What the scraper remembers about a source between runs, used to skip feeds which have not changed.
+    """
+    __tablename__ = 'scraper_source_state'
+
+    source_id = Column(Integer, ForeignKey('scraper_source.source_id'), primary_key=True)
+    etag = Column(String(255), nullable=True)
+    last_modified = Column(String(64), nullable=True)
+    body_digest = Column(String(40), nullable=True)
+    # created_at (UTC) of the newest article stored from the source
+    watermark = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+    # Relationship
+    source = relationship("ScraperSource", back_populates="state")
+
+
+class ScraperSourceLease(BaseMixin):
+    """
+    Which worker of a sharded crawl owns a source. A lease is renewed by its worker's heartbeat and can be claimed
+    by another worker once it expires; released leases remember when the source was crawled.
+    """
+    __tablename__ = 'scraper_source_lease'
+
+    source_id = Column(Integer, ForeignKey('scraper_source.source_id'), primary_key=True)
+    worker_id = Column(String(255), nullable=True)
+    # The claim which took the lease, tells apart the leases a worker won from the ones it raced for
+    claim_id = Column(String(32), nullable=True)
+    # UTC
+    expires_at = Column(DateTime, nullable=True)
+    crawled_at = Column(DateTime, nullable=True)
 
 
 class User(BaseMixin):
@@ -77,6 +167,8 @@ class Article(BaseMixin):
     title = Column(String(255), nullable=False)
     slug = Column(String(255), unique=True, nullable=False)
     content = Column(Text, nullable=False)
+    # The content when it is stored compressed (ARTICLE_CONTENT_STORAGE = "compressed"), content is empty then
+    content_body = Column(CompressedText, nullable=True)
     status = Column(Enum('draft', 'published', 'archived'), default='draft')
     journalist_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
     category_id = Column(Integer, ForeignKey('categories.category_id'), nullable=False)
@@ -87,16 +179,70 @@ class Article(BaseMixin):
 
     news_hash = Column(String(40), unique=True, nullable=False, primary_key=True)
     source_url = Column(String(2048), nullable=False)
+    # article_digest of the stored columns, a re-scraped article with the same digest is not rewritten
+    content_digest = Column(String(40), nullable=True)
 
     # Relationships
     journalist = relationship("User", back_populates="articles")
     category = relationship("Category", back_populates="articles")
     city = relationship("City", back_populates="articles")
     media = relationship('Media', back_populates='articles')
+    simhash = relationship('ArticleSimHash', back_populates='article', uselist=False)
+
+    @property
+    def body(self) -> str:
+        """
+        The content of the article, wherever it is stored. Setting it stores it compressed.
+        """
+        # content is emptied when the content is stored compressed, it wins if the storage was switched back to text
+        return self.content or self.content_body or ''
+
+    @body.setter
+    def body(self, value: str) -> None:
+        self.content_body = value
+        self.content = ''
+
+
+# The columns of an article written by the MySQLPipeline
+DIGEST_COLUMNS = ('title', 'slug', 'content', 'content_body', 'journalist_id', 'category_id', 'city_id', 'created_at',
+                  'source_url')
+
+
+def article_digest(row: Mapping) -> str:
+    """
+    SHA1 of the DIGEST_COLUMNS of an article row, as written by the pipeline or read back from the database (naive UTC
+    times, a missing column is NULL).
+    """
+    digest = hashlib.sha1()
+    for column in DIGEST_COLUMNS:
+        value = row.get(column)
+        if isinstance(value, datetime) and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        digest.update(b'\x01' if value is None else str(value).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+class ArticleSimHash(BaseMixin):
+    """
+    SimHashes of an article, loaded into the near duplicate index when the spider opens. Stored as signed 64-bit.
+    """
+    __tablename__ = 'article_simhash'
+
+    news_hash = Column(String(40), ForeignKey('articles.news_hash', ondelete='CASCADE', onupdate='CASCADE'),
+                       primary_key=True)
+    title_simhash = Column(BigInteger, nullable=True)
+    content_simhash = Column(BigInteger, nullable=True)
+    created_at = Column(TIMESTAMP, index=True)
+
+    # Relationship
+    article = relationship('Article', back_populates='simhash')
 
 
 class Media(BaseMixin):
     __tablename__ = 'media'
+    # The key of the media upsert, workers of a sharded crawl may store the same article at the same time
+    __table_args__ = (UniqueConstraint('article_id', 'media_url', name='uq_media_article_url'),)
 
     media_id = Column(Integer, primary_key=True, autoincrement=True)
     article_id = Column(Integer, ForeignKey('articles.article_id'), nullable=False)
@@ -108,13 +254,114 @@ class Media(BaseMixin):
     articles = relationship("Article", back_populates="media")
 
 
-session_factory: sessionmaker = None
-Session: scoped_session[SessionType] = None
+class SchemaVersion(BaseMixin):
+    """
+    The SCHEMA_VERSION the database was last checked against, one row per version.
+    """
+    __tablename__ = 'schema_version'
 
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
 
-def init_db(connection_string: str):
-    engine = create_engine(connection_string)
-    Base.metadata.create_all(engine)
+
+session_factory: sessionmaker = None
+Session: scoped_session[SessionType] = None
+async_session_factory: async_sessionmaker[AsyncSession] = None
+
+
+def init_db(connection_string: str, schema_check: str = 'create_all', unused_columns: Iterable[str] = (),
+            **engine_options):
+    """
+    `schema_check` is "create_all" (create the missing tables, which inspects them one by one) or "version" (a single
+    query of the schema version, the tables are only inspected when it is behind). The "version" check does not require
+    the `unused_columns` ("table.column"), which the settings of the run do not write.
+    """
+    engine = create_engine(connection_string, **engine_options)
+    if schema_check == 'version':
+        check_schema_version(engine, unused_columns)
+    else:
+        Base.metadata.create_all(engine)
     global session_factory, Session
     session_factory = sessionmaker(bind=engine)
     Session = scoped_session(session_factory)
+
+
+def unique_key_names(inspector, table_name: str) -> set[str]:
+    # A unique constraint is reflected as an index on MySQL and as a constraint on SQLite
+    return (
+        {index['name'] for index in inspector.get_indexes(table_name) if index['unique']}
+        | {constraint['name'] for constraint in inspector.get_unique_constraints(table_name)}
+    )
+
+
+def check_schema_version(engine: Engine, unused_columns: Iterable[str] = ()) -> None:
+    """
+    Does nothing when the database is at SCHEMA_VERSION. Otherwise creates the missing tables and, when every column
+    and unique key of the models exists, records the version; missing columns of existing tables need the migrations
+    (NewsScraper.newsdb.migrations) first. Missing `unused_columns` only log a warning, the version is recorded once
+    they are added (--add-column-only adds them without migrating the rows).
+    """
+    try:
+        with engine.connect() as connection:
+            if connection.scalar(select(func.max(SchemaVersion.version))) == SCHEMA_VERSION:
+                return
+    except SQLAlchemyError:
+        pass
+
+    Base.metadata.create_all(engine)
+
+    inspector = inspect(engine)
+    missing_columns, missing_keys = [], []
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        missing_columns += [f'{table.name}.{column.name}' for column in table.columns if column.name not in existing_columns]
+        unique_keys = {constraint.name for constraint in table.constraints if isinstance(constraint, UniqueConstraint)
+                       and constraint.name}
+        if unique_keys:
+            missing_keys += [f'{table.name}.{name}' for name in unique_keys - unique_key_names(inspector, table.name)]
+
+    unused_columns = set(unused_columns)
+    if required := [column for column in missing_columns if column not in unused_columns] + missing_keys:
+        raise RuntimeError(f'The database is missing {", ".join(required)}, run the migrations')
+    if missing_columns:
+        logger.warning(f'The database is missing the columns {", ".join(missing_columns)}, unused with the current '
+                       f'settings; run the migrations before using them')
+        return
+
+    try:
+        with engine.begin() as connection:
+            connection.execute(SchemaVersion.__table__.insert().values(version=SCHEMA_VERSION))
+    except IntegrityError:
+        # Another worker recorded it first
+        pass
+
+
+def init_async_db(connection_string: str, **engine_options):
+    """
+    Creates the asyncio engine used by the async persistence mode, the schema is created by init_db.
+    """
+    engine = create_async_engine(connection_string, **engine_options)
+    global async_session_factory
+    async_session_factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def upsert(session: SessionType | AsyncSession, table: Table, rows: list[dict], index_elements: list[str], update_columns: list[str]) -> Insert:
+    """
+    Builds a single multi-row INSERT that updates `update_columns` when a row with the same key already exists.
+
+    MySQL uses ``INSERT ... ON DUPLICATE KEY UPDATE``, SQLite (used as a local stand-in) uses ``ON CONFLICT DO UPDATE``.
+    """
+    dialect_name = session.get_bind().dialect.name
+
+    if dialect_name == 'mysql':
+        statement = mysql.insert(table).values(rows)
+        return statement.on_duplicate_key_update({column: statement.inserted[column] for column in update_columns})
+
+    if dialect_name == 'sqlite':
+        statement = sqlite.insert(table).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: statement.excluded[column] for column in update_columns}
+        )
+
+    raise NotImplementedError(f'Upsert is not supported for dialect: {dialect_name}')
@@ -2,39 +2,53 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-import importlib.resources as pkg_resources
-import json
-import re
-from collections import defaultdict
+import time
 from datetime import datetime, timezone
+from typing import Iterable
 from urllib.parse import urlparse
 
-from bs4 import BeautifulSoup, NavigableString
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
-from scrapy.exceptions import DropItem
-from sqlalchemy.exc import SQLAlchemyError
+from scrapy.crawler import Crawler
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.statscollectors import StatsCollector
+from scrapy.utils.defer import deferred_from_coro
+from sqlalchemy import select, exists, update, Select, Insert, Update
+from sqlalchemy.exc import SQLAlchemyError, OperationalError, InterfaceError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session as SessionType
+from tenacity import Retrying, AsyncRetrying, stop_after_attempt, wait_exponential, retry_if_exception_type
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.task import LoopingCall
 from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
 
 import NewsScraper.newsdb.models as models
+from NewsScraper import executors
+from NewsScraper.dedup import SimHasher, to_signed64
+from NewsScraper.extensions import record_stage
+from NewsScraper.items import ArticleItem
+from NewsScraper.sanitizers import ContentSanitizer, LxmlContentSanitizer, SANITIZERS
 from NewsScraper.spiders.base_spider import BaseNewsSpider
-from NewsScraper.utils import get_domain
 
 
 class DefaultPipeline:
 
-    def __init__(self):
-        remove_references_data = pkg_resources.read_text('NewsScraper.resources', 'remove_references.json')
-        self.remove_references_re = defaultdict(list)
-        for domain, references in json.loads(remove_references_data).items():
-            for reference in references:
-                compiled_reference_regex = re.compile(rf'\b{re.escape(reference)}\b', re.IGNORECASE)
-                self.remove_references_re[domain].append(compiled_reference_regex)
+    def __init__(self, sanitizer_cls: type[ContentSanitizer] = LxmlContentSanitizer):
+        self.sanitizer_cls = sanitizer_cls
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        return cls(sanitizer_cls=SANITIZERS[crawler.settings.get('CONTENT_SANITIZER', 'lxml')])
 
     async def process_item(self, item, spider):
+        started = time.perf_counter()
         item_adapter = ItemAdapter(item)
 
+        # The page could not be parsed: the source is marked failed so its watermark does not move past the article
         if not item_adapter.get('content'):
+            spider.mark_source_failed(item_adapter.get('source_id'))
             raise DropItem()
 
         if not item_adapter.get('slug'):
@@ -42,54 +56,403 @@ class DefaultPipeline:
             source_slug = path.rpartition('/')[2].partition('.')[0]
             item_adapter['slug'] = f'{source_slug}-{item_adapter["created_at"]}'
 
-        content_bs = BeautifulSoup(item_adapter['content'], 'html.parser')
+        item_adapter['content'], featured_image = await executors.run(
+            self.sanitizer_cls,
+            'sanitize',
+            item_adapter['content'],
+            item_adapter['source_url'],
+            item_adapter.get('featured_image'),
+        )
+        if featured_image:
+            item_adapter['featured_image'] = featured_image
+
+        record_stage('default_pipeline', time.perf_counter() - started)
+        return item
 
-        if not item_adapter.get('featured_image') and (img := content_bs.find('img')):
-            item_adapter['featured_image'] = img['src']
 
-        root_domain = get_domain(item_adapter['source_url'])
-        for href in content_bs.find_all('a'):
-            href_domain = get_domain(href['href'])
-            if not href_domain or href_domain == root_domain:
-                href.replace_with(href.text)
+class NearDuplicatePipeline:
+    """
+    Drops the articles whose title plus beginning of the content is a near duplicate (SimHash) of an article stored
+    recently or already processed in this run, and keeps the SimHashes of the others for the MySQLPipeline to store.
+    The index is the spider's near_duplicate_index.
+    """
 
-        for reference_re in self.remove_references_re.get(root_domain) or []:
-            for _string in list(content_bs.strings):  # type: NavigableString
-                if reference_re.search(_string):
-                    _string.replace_with('')
+    def __init__(self, stats: StatsCollector):
+        self.stats = stats
 
-        item_adapter['content'] = str(content_bs)
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        if not crawler.settings.getbool('NEAR_DUPLICATE_ENABLED'):
+            raise NotConfigured
+        return cls(crawler.stats)
+
+    async def process_item(self, item, spider):
+        if (near_duplicate_index := getattr(spider, 'near_duplicate_index', None)) is None:
+            return item
 
+        item_adapter = ItemAdapter(item)
+        content_simhash = await executors.run(
+            SimHasher,
+            'content_simhash',
+            item_adapter.get('title'),
+            item_adapter.get('content'),
+            near_duplicate_index.content_chars,
+            near_duplicate_index.content_shingle_size,
+        )
+        if content_simhash is None:
+            return item
+
+        duplicate_of, collisions = near_duplicate_index.contents.find(content_simhash)
+        if collisions:
+            self.stats.inc_value('near_duplicate/content_collisions', collisions)
+        if duplicate_of is not None and duplicate_of != item_adapter['news_hash']:
+            self.stats.inc_value('near_duplicate/content_dropped')
+            raise DropItem(f'Near duplicate of {duplicate_of}')
+
+        near_duplicate_index.contents.add(content_simhash, item_adapter['news_hash'])
+        item_adapter['content_simhash'] = content_simhash
         return item
 
 
 class MySQLPipeline:
+    """
+    Buffers items and writes them in batches, one multi-row upsert per table and a single commit per batch.
+
+    A batch is flushed when it reaches MYSQL_BATCH_SIZE items, every MYSQL_BATCH_FLUSH_INTERVAL seconds and when the
+    spider closes. Each item's deferred fires only after the batch containing it has been committed.
+
+    Batches are written with the asyncio engine when MYSQL_ASYNC_ENABLED is set, otherwise in the reactor thread pool.
+
+    Articles whose stored columns have the same digest as the stored row are not rewritten (one digest query per
+    batch), only their updated_at is touched when `touch_unchanged` is set, and their SimHashes are left as they are.
+
+    With `compress_content` the whole content is stored compressed in content_body, otherwise it is truncated to
+    60,000 characters in content.
+    """
+
+    ARTICLE_COLUMNS = [column.name for column in models.Article.__table__.columns if column.name in ArticleItem.fields]
+
+    def __init__(self, stats: StatsCollector, batch_size: int = 50, flush_interval: float = 5, retry_times: int = 3,
+                 retry_backoff: float = 1, split_on_failure: bool = True, touch_unchanged: bool = True,
+                 compress_content: bool = False):
+        self.stats = stats
+        self.touch_unchanged = touch_unchanged
+        self.compress_content = compress_content
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.split_on_failure = split_on_failure
+        retry_options = dict(
+            stop=stop_after_attempt(retry_times + 1),
+            wait=wait_exponential(multiplier=retry_backoff),
+            retry=retry_if_exception_type((OperationalError, InterfaceError)),
+            reraise=True,
+        )
+        self.retrying = Retrying(**retry_options)
+        self.async_retrying = AsyncRetrying(**retry_options)
+
+        self.pending: list[tuple[dict, Deferred]] = []
+        # When each pending item was queued, for the mysql_queue stage latency
+        self.pending_since: list[float] = []
+        self.flushing: set[Deferred] = set()
+        self.flush_loop: LoopingCall | None = None
+        self.spider: BaseNewsSpider = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        return cls(
+            stats=crawler.stats,
+            batch_size=crawler.settings.getint('MYSQL_BATCH_SIZE', 50),
+            flush_interval=crawler.settings.getfloat('MYSQL_BATCH_FLUSH_INTERVAL', 5),
+            retry_times=crawler.settings.getint('MYSQL_BATCH_RETRY_TIMES', 3),
+            retry_backoff=crawler.settings.getfloat('MYSQL_BATCH_RETRY_BACKOFF', 1),
+            split_on_failure=crawler.settings.getbool('MYSQL_BATCH_SPLIT_ON_FAILURE', True),
+            touch_unchanged=crawler.settings.get('MYSQL_UNCHANGED_ARTICLES', 'touch') == 'touch',
+            compress_content=crawler.settings.get('ARTICLE_CONTENT_STORAGE', 'text') == 'compressed',
+        )
+
+    def open_spider(self, spider: BaseNewsSpider):
+        self.spider = spider
+        if self.flush_interval > 0:
+            self.flush_loop = LoopingCall(self.flush)
+            self.flush_loop.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider: BaseNewsSpider):
+        if self.flush_loop and self.flush_loop.running:
+            self.flush_loop.stop()
+
+        self.flush()
+        return DeferredList(list(self.flushing))
 
     def process_item(self, item, spider: BaseNewsSpider):
-        return deferToThread(self._process_item, item, spider)
+        stored = Deferred()
+        self.pending.append((item, stored))
+        self.pending_since.append(time.perf_counter())
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+        return stored
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        flush_started = time.perf_counter()
+        for queued in self.pending_since:
+            record_stage('mysql_queue', flush_started - queued)
+        self.pending_since = []
+
+        items = [ItemAdapter(item).asdict() for item, _ in batch]
+        if models.async_session_factory is not None:
+            flushing = deferred_from_coro(self._write_batch_with_retry_async(items))
+        else:
+            flushing = deferToThread(self._write_batch_with_retry, items)
+
+        flushing.addCallbacks(self._batch_written, self._batch_failed, callbackArgs=(batch,), errbackArgs=(batch,))
+
+        self.flushing.add(flushing)
+        flushing.addBoth(self._flush_finished, flushing, flush_started)
+
+    def _batch_written(self, failures: dict[int, Exception], batch: list[tuple[dict, Deferred]]) -> None:
+        self.stats.inc_value('mysql_pipeline/batches')
+        self.stats.inc_value('mysql_pipeline/items_stored', len(batch) - len(failures))
+
+        # The items are released even if a spider hook raises, or their responses would never finish processing
+        try:
+            self.spider.on_items_stored([item for index, (item, _) in enumerate(batch) if index not in failures])
+            if failures:
+                self.spider.on_items_failed([item for index, (item, _) in enumerate(batch) if index in failures])
+
+        finally:
+            for index, (item, stored) in enumerate(batch):
+                if index in failures:
+                    self.stats.inc_value('mysql_pipeline/items_failed')
+                    stored.errback(Failure(failures[index]))
+                else:
+                    stored.callback(item)
+
+    def _batch_failed(self, failure: Failure, batch: list[tuple[dict, Deferred]]) -> None:
+        self.stats.inc_value('mysql_pipeline/batches_failed')
+        self.stats.inc_value('mysql_pipeline/items_failed', len(batch))
+        try:
+            self.spider.on_items_failed([item for item, _ in batch])
+
+        finally:
+            for _, stored in batch:
+                stored.errback(failure)
+
+    def _flush_finished(self, _, flushing: Deferred, flush_started: float) -> None:
+        self.flushing.discard(flushing)
+        record_stage('mysql_write', time.perf_counter() - flush_started)
+
+    def _write_batch_with_retry(self, items: list[dict]) -> dict[int, Exception]:
+        try:
+            self.retrying(self._write_batch, items)
+            return {}
+
+        except SQLAlchemyError:
+            if not self.split_on_failure or len(items) == 1:
+                raise
+
+        # Isolate the rows that keep failing, so that one bad item does not fail the whole batch
+        failures = {}
+        for index, item in enumerate(items):
+            try:
+                self.retrying(self._write_batch, [item])
+            except SQLAlchemyError as ex:
+                failures[index] = ex
+        return failures
+
+    async def _write_batch_with_retry_async(self, items: list[dict]) -> dict[int, Exception]:
+        try:
+            await self.async_retrying(self._write_batch_async, items)
+            return {}
+
+        except SQLAlchemyError:
+            if not self.split_on_failure or len(items) == 1:
+                raise
+
+        failures = {}
+        for index, item in enumerate(items):
+            try:
+                await self.async_retrying(self._write_batch_async, [item])
+            except SQLAlchemyError as ex:
+                failures[index] = ex
+        return failures
+
+    def _write_batch(self, items: list[dict]) -> None:
+        featured_images = self._featured_images(items)
+        article_rows = self._article_rows(items)
 
-    def _process_item(self, item, spider: BaseNewsSpider):
         with models.Session() as session:
             try:
-                article_item = models.Article(**item)
-                article_item.content = article_item.content[0:60_000]
-                article_item.created_at = datetime.fromtimestamp(article_item.created_at, timezone.utc)
+                stored_digests = dict(session.execute(self._stored_digests_query(article_rows)).all())
+                changed_rows, unchanged_hashes = self._split_unchanged(article_rows, stored_digests)
 
-                article_item = session.merge(article_item)
-                session.commit()
+                if changed_rows:
+                    session.execute(self._article_upsert(session, changed_rows))
+                if unchanged_hashes and self.touch_unchanged:
+                    session.execute(self._touch_query(unchanged_hashes))
+                if simhash_rows := self._simhash_rows(items, unchanged_hashes):
+                    session.execute(self._simhash_upsert(session, simhash_rows))
+
+                if featured_images:
+                    articles_without_media = session.execute(self._articles_without_media_query(featured_images))
+                    if media_rows := self._media_rows(articles_without_media, featured_images):
+                        session.execute(self._media_upsert(session, media_rows))
 
-                if (featured_image_url := item.get('featured_image')) \
-                        and not session.query(models.Media).filter_by(article_id=article_item.article_id).first():
-                    media_item = models.Media(
-                        article_id=article_item.article_id,
-                        media_url=featured_image_url,
-                        media_type='image'
-                    )
-                    session.merge(media_item)
-                    session.commit()
+                session.commit()
 
             except SQLAlchemyError:
                 session.rollback()
                 raise
 
-        return item
+        reactor.callFromThread(self._count_unchanged, len(unchanged_hashes))
+
+    async def _write_batch_async(self, items: list[dict]) -> None:
+        featured_images = self._featured_images(items)
+        article_rows = self._article_rows(items)
+
+        async with models.async_session_factory() as session:
+            try:
+                stored_digests = dict((await session.execute(self._stored_digests_query(article_rows))).all())
+                changed_rows, unchanged_hashes = self._split_unchanged(article_rows, stored_digests)
+
+                if changed_rows:
+                    await session.execute(self._article_upsert(session, changed_rows))
+                if unchanged_hashes and self.touch_unchanged:
+                    await session.execute(self._touch_query(unchanged_hashes))
+                if simhash_rows := self._simhash_rows(items, unchanged_hashes):
+                    await session.execute(self._simhash_upsert(session, simhash_rows))
+
+                if featured_images:
+                    articles_without_media = await session.execute(self._articles_without_media_query(featured_images))
+                    if media_rows := self._media_rows(articles_without_media, featured_images):
+                        await session.execute(self._media_upsert(session, media_rows))
+
+                await session.commit()
+
+            except SQLAlchemyError:
+                await session.rollback()
+                raise
+
+        self._count_unchanged(len(unchanged_hashes))
+
+    def _article_rows(self, items: list[dict]) -> dict[str, dict]:
+        article_rows = {}
+        for item in items:
+            article_row = {column: item.get(column) for column in self.ARTICLE_COLUMNS}
+            if self.compress_content:
+                article_row['content_body'], article_row['content'] = article_row['content'], ''
+            else:
+                article_row['content'] = article_row['content'][0:60_000]
+            if article_row['created_at'] is not None:
+                article_row['created_at'] = datetime.fromtimestamp(article_row['created_at'], timezone.utc)
+            article_row['content_digest'] = models.article_digest(article_row)
+            article_rows[article_row['news_hash']] = article_row
+        return article_rows
+
+    @staticmethod
+    def _stored_digests_query(article_rows: dict[str, dict]) -> Select:
+        return (
+            select(models.Article.news_hash, models.Article.content_digest)
+            .where(models.Article.news_hash.in_(list(article_rows)))
+        )
+
+    @staticmethod
+    def _split_unchanged(article_rows: dict[str, dict], stored_digests: dict[str, str]) -> tuple[list[dict], list[str]]:
+        changed_rows, unchanged_hashes = [], []
+        for news_hash, article_row in article_rows.items():
+            if stored_digests.get(news_hash) == article_row['content_digest']:
+                unchanged_hashes.append(news_hash)
+            else:
+                changed_rows.append(article_row)
+        return changed_rows, unchanged_hashes
+
+    @staticmethod
+    def _article_upsert(session: SessionType | AsyncSession, article_rows: list[dict]) -> Insert:
+        return models.upsert(
+            session,
+            models.Article.__table__,
+            article_rows,
+            index_elements=['news_hash'],
+            update_columns=[column for column in article_rows[0] if column != 'news_hash'],
+        )
+
+    @staticmethod
+    def _touch_query(news_hashes: list[str]) -> Update:
+        return (
+            update(models.Article)
+            .where(models.Article.news_hash.in_(news_hashes))
+            .values(updated_at=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        )
+
+    def _count_unchanged(self, count: int) -> None:
+        if count:
+            self.stats.inc_value('mysql_pipeline/rewrites_avoided', count)
+
+    @staticmethod
+    def _simhash_rows(items: list[dict], unchanged_hashes: list[str]) -> list[dict]:
+        simhash_rows = {}
+        unchanged_hashes = set(unchanged_hashes)
+        for item in items:
+            if item['news_hash'] in unchanged_hashes:
+                continue
+
+            title_simhash, content_simhash = item.get('title_simhash'), item.get('content_simhash')
+            if title_simhash is None and content_simhash is None:
+                continue
+
+            simhash_rows[item['news_hash']] = {
+                'news_hash': item['news_hash'],
+                'title_simhash': to_signed64(title_simhash) if title_simhash is not None else None,
+                'content_simhash': to_signed64(content_simhash) if content_simhash is not None else None,
+                # Undated articles are kept in the index for NEAR_DUPLICATE_INDEX_DAYS from now
+                'created_at': datetime.fromtimestamp(item.get('created_at') or time.time(), timezone.utc),
+            }
+        return list(simhash_rows.values())
+
+    @staticmethod
+    def _simhash_upsert(session: SessionType | AsyncSession, simhash_rows: list[dict]) -> Insert:
+        return models.upsert(
+            session,
+            models.ArticleSimHash.__table__,
+            simhash_rows,
+            index_elements=['news_hash'],
+            update_columns=['title_simhash', 'content_simhash', 'created_at'],
+        )
+
+    @staticmethod
+    def _featured_images(items: list[dict]) -> dict[str, str]:
+        return {item['news_hash']: item['featured_image'] for item in items if item.get('featured_image')}
+
+    @staticmethod
+    def _articles_without_media_query(featured_images: dict[str, str]) -> Select:
+        return (
+            select(models.Article.article_id, models.Article.news_hash)
+            .where(models.Article.news_hash.in_(list(featured_images)))
+            .where(~exists().where(models.Media.article_id == models.Article.article_id))
+        )
+
+    @staticmethod
+    def _media_rows(articles_without_media: Iterable[tuple[int, str]], featured_images: dict[str, str]) -> list[dict]:
+        return [
+            {
+                'article_id': article_id,
+                'media_url': featured_images[news_hash],
+                'media_type': 'image',
+            }
+            for article_id, news_hash in articles_without_media
+        ]
+
+    @staticmethod
+    def _media_upsert(session: SessionType | AsyncSession, media_rows: list[dict]) -> Insert:
+        return models.upsert(
+            session,
+            models.Media.__table__,
+            media_rows,
+            index_elements=['article_id', 'media_url'],
+            update_columns=['media_type'],
+        )
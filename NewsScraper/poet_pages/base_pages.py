@@ -1,12 +1,13 @@
 import logging
+from datetime import datetime
 from typing import Iterable
 
 import attr
-import dateparser
-import feedparser
 import web_poet
 from web_poet.pages import WebPage
 
+from NewsScraper.dates import feed_date_parser
+from NewsScraper.feeds import FEED_ENGINES
 from NewsScraper.items import ArticleItem
 from NewsScraper.loaders import ArticleItemLoader
 from NewsScraper.providers import HttpClientEx
@@ -16,6 +17,7 @@ from NewsScraper.providers import HttpClientEx
 class BasePage(WebPage):
     http: HttpClientEx
     page_params: web_poet.PageParams
+    stats: web_poet.Stats
 
     logger = logging.getLogger(__name__)
 
@@ -30,7 +32,7 @@ class ArticleResultsPage(BasePage):
 class ArticlePage(BasePage):
     init_item: ArticleItem
 
-    def to_item(self) -> ArticleItem:
+    async def to_item(self) -> ArticleItem:
         pass
 
 
@@ -49,18 +51,38 @@ class ArticleRssPage(ArticleResultsPage):
         """
         return True
 
+    def is_below_watermark(self, published: datetime | None, watermark: int | None) -> bool:
+        """
+        Returns True if the entry was published at or before the source's watermark (a UTC timestamp), i.e. it was
+        already seen in a previous run.
+        """
+        if watermark is None or published is None:
+            return False
+        return published.timestamp() <= watermark
+
     def parse_articles(self) -> Iterable[ArticleItem]:
-        for entry in feedparser.parse(self.response.text)['entries']:
-            item_loader = ArticleItemLoader()
+        watermark = self.page_params.get('watermark')
+        feed_engine = FEED_ENGINES[self.page_params.get('feed_engine', 'streaming')]()
+        news_hash_mode = self.page_params.get('news_hash_mode', 'compat')
+
+        for entry in feed_engine.iter_entries(self.response.body):
+            parsed_date, date_tier, cached = feed_date_parser.parse_entry(entry)
+            self.stats.inc(f'date_parser/{date_tier}')
+            if cached:
+                self.stats.inc('date_parser/cache_hits')
+
+            if self.is_below_watermark(parsed_date, watermark):
+                self.stats.inc('watermark/skipped_entries')
+                continue
+
+            item_loader = ArticleItemLoader(news_hash_mode=news_hash_mode)
 
             item_loader.add_value('source_url', entry['link'])
             item_loader.add_value('title', entry['title'])
-
-            parsed_date = dateparser.parse(entry['published'])
             item_loader.add_value('created_at', parsed_date)
 
             for media in entry.get('media_content', []):
-                if media['medium'] == 'image':
+                if media.get('medium') == 'image':
                     item_loader.add_value('featured_image', media['url'])
                     break
 
@@ -70,3 +92,7 @@ class ArticleRssPage(ArticleResultsPage):
                 yield item
             else:
                 self.logger.info(f'Filtered out article: {item["source_url"]}')
+
+        self.stats.inc(f'feed_engine/{feed_engine.name}')
+        if getattr(feed_engine, 'fallbacks', 0):
+            self.stats.inc('feed_engine/fallbacks', feed_engine.fallbacks)
@@ -1,11 +1,12 @@
-from typing import Iterable
+from html import escape
+from typing import Iterable, Callable
 
 from bs4 import BeautifulSoup, Tag
-from jsonpath_ng import parse
 
+from NewsScraper import executors
 from NewsScraper.items import ArticleItem
 from NewsScraper.poet_pages.base_pages import ArticlePage, ArticleRssPage
-from NewsScraper.utils import get_script_json
+from NewsScraper.utils import get_script_json_fast
 
 
 class NyTimesRssPage(ArticleRssPage):
@@ -23,11 +24,10 @@ class NyTimesRssPage(ArticleRssPage):
 
 
 class NyTimesArticlePage(ArticlePage):
-    def to_item(self):
-        nytimes_parser = NyTimesParser()
-
+    async def to_item(self):
         try:
-            content = nytimes_parser.parse(self.response.text)
+            parser_cls = NYTIMES_PARSERS[self.page_params.get('parser_backend', 'html')]
+            content = await executors.run(parser_cls, 'parse', bytes(self.response.body), self.response.encoding)
             self.init_item['content'] = content
 
         except Exception as ex:
@@ -77,14 +77,27 @@ class NyTimesParser:
 
     def __init__(self):
         self.b_soup: BeautifulSoup = None
-        self.content_expression = parse('$..content')
-        self.image_url_expression = parse('$..crops[0].renditions[0].url')
-
-        self.caption_expression = parse('$..caption | $..legacyHtmlCaption')
-
-    def parse(self, news_html: str) -> str:
 
-        news_json = get_script_json(news_html, 'window.__preloadedData\s*=')
+        self.block_handlers: dict[str, Callable[[dict], Iterable[Tag]]] = {
+            **{block_type: self.parse_paragraph_block for block_type in self.PARAGRAPH_TYPES},
+            **{block_type: self.parse_header_block for block_type in self.HEADERS},
+            'ImageBlock': self.parse_image_block,
+            'DiptychBlock': self.parse_diptych_block,
+            'GridBlock': self.parse_grid_block,
+            'VisualStackBlock': self.parse_visual_stack_block,
+            'ListBlock': self.parse_list_block,
+            'YouTubeEmbedBlock': self.parse_youtube_block,
+            'RuleBlock': self.parse_rule_block,
+            'LineBreakInline': self.parse_line_break_block,
+            # TODO: This is the gallery widget, e.g. https://www.nytimes.com/2024/10/10/style/handbag-shape-trend-dachshund-bag.html
+            'CardDeckBlock': self.skip_block,
+            # TODO: This is the video widget(GIF like), e.g. https://www.nytimes.com/2024/10/13/business/millennials-spending.html
+            'VideoBlock': self.skip_block,
+        }
+
+    def parse(self, news_html: str | bytes, encoding: str = 'utf-8') -> str:
+
+        news_json = get_script_json_fast(news_html, 'window.__preloadedData', encoding)
         try:
             article_blocks = news_json['initialData']['data']['article']['sprinkledBody']['content']
         except (KeyError, TypeError):
@@ -111,67 +124,59 @@ class NyTimesParser:
             if block_type in self.IGNORE_BLOCKS:
                 continue
 
-            elif block_type in self.PARAGRAPH_TYPES:
-                yield from self.parse_paragraph_block(block)
+            if (block_handler := self.block_handlers.get(block_type)) is None:
+                raise Exception(f'Unknown block type: {block_type}')
 
-            elif block_type in self.HEADERS:
-                yield from self.parse_paragraph_block(block.get('headline'))
-                yield from self.parse_paragraph_block(block.get('summary'))
-                yield from self.parse_image_block(block.get('ledeMedia'))
+            yield from block_handler(block)
 
-            elif block_type == 'ImageBlock':
-                yield from self.parse_image_block(block)
+    def parse_header_block(self, block: dict):
+        yield from self.parse_paragraph_block(block.get('headline'))
+        yield from self.parse_paragraph_block(block.get('summary'))
+        yield from self.parse_image_block(block.get('ledeMedia'))
 
-            elif block_type == 'DiptychBlock':
-                yield from self.parse_image_block(block['imageOne'])
-                yield from self.parse_image_block(block['imageTwo'])
+    def parse_diptych_block(self, block: dict):
+        yield from self.parse_image_block(block['imageOne'])
+        yield from self.parse_image_block(block['imageTwo'])
 
-            elif block_type == 'GridBlock':
-                for image in block['gridMedia']:
-                    yield from self.parse_image_block(image)
-                yield self.create_element_from_block('figcaption', block)
+    def parse_grid_block(self, block: dict):
+        for image in block['gridMedia']:
+            yield from self.parse_image_block(image)
+        yield self.create_element_from_block('figcaption', block)
 
-            elif block_type == 'VisualStackBlock':
-                yield from self.parse_image_block(block['vsMedia'], False)
-                for content_block in block['content']:
-                    yield from self.parse_paragraph_block(content_block)
+    def parse_visual_stack_block(self, block: dict):
+        yield from self.parse_image_block(block['vsMedia'], False)
+        for content_block in block['content']:
+            yield from self.parse_paragraph_block(content_block)
 
-            elif block_type == 'ListBlock':
-                if block.get('style') == 'UNORDERED':
-                    list_tag = self.b_soup.new_tag('ul')
-                else:
-                    list_tag = self.b_soup.new_tag('ol')
+    def parse_list_block(self, block: dict):
+        if block.get('style') == 'UNORDERED':
+            list_tag = self.b_soup.new_tag('ul')
+        else:
+            list_tag = self.b_soup.new_tag('ol')
 
-                for list_content in block['content']:
-                    if list_item := self.create_element_from_block('li', list_content):
-                        list_tag.append(list_item)
-                yield list_tag
+        for list_content in block['content']:
+            if list_item := self.create_element_from_block('li', list_content):
+                list_tag.append(list_item)
+        yield list_tag
 
-            elif block_type == 'YouTubeEmbedBlock':
-                yield self.b_soup.new_tag('iframe', src=f'https://www.youtube.com/embed/{block["youTubeId"]}')
+    def parse_youtube_block(self, block: dict):
+        yield self.b_soup.new_tag('iframe', src=f'https://www.youtube.com/embed/{block["youTubeId"]}')
 
-            elif block_type == 'RuleBlock':
-                yield self.b_soup.new_tag('hr')
+    def parse_rule_block(self, block: dict):
+        yield self.b_soup.new_tag('hr')
 
-            elif block_type == 'LineBreakInline':
-                yield self.b_soup.new_tag('br')
+    def parse_line_break_block(self, block: dict):
+        yield self.b_soup.new_tag('br')
 
-            elif block_type == 'CardDeckBlock':
-                # TODO: This is the gallery widget, e.g. https://www.nytimes.com/2024/10/10/style/handbag-shape-trend-dachshund-bag.html
-                pass
-            elif block_type == 'VideoBlock':
-                # TODO: This is the video widget(GIF like), e.g. https://www.nytimes.com/2024/10/13/business/millennials-spending.html
-                pass
+    def skip_block(self, block: dict):
+        yield from ()
 
-            else:
-                raise Exception(f'Unknown block type: {block_type}')
-
-    def create_element_from_block(self, element_tag: str, block: dict) -> Tag:
+    def create_element_from_block(self, element_tag: str, block: dict, block_scan: 'BlockScan' = None) -> Tag:
         if not block:
             return
 
         element = self.b_soup.new_tag(element_tag)
-        self.parse_block_content(block, element)
+        self.parse_block_content(block, element, block_scan)
         return element
 
     def parse_paragraph_block(self, block: dict):
@@ -182,34 +187,32 @@ class NyTimesParser:
     def parse_image_block(self, block: dict, parse_caption: bool = True):
         if not block:
             return
-        try:
-            image_src = self.image_url_expression.find(block)[0].value
-        except IndexError:
+
+        block_scan = BlockScan(block)
+        if not block_scan.has_image_url:
             return
 
-        image_block = self.b_soup.new_tag('img', src=image_src)
+        image_block = self.b_soup.new_tag('img', src=block_scan.image_url)
         yield image_block
         if parse_caption:
-            yield self.create_element_from_block('figcaption', block)
+            yield self.create_element_from_block('figcaption', block, block_scan)
 
-    def parse_block_content(self, block: dict, parent_tag: Tag) -> None:
+    def parse_block_content(self, block: dict, parent_tag: Tag, block_scan: 'BlockScan' = None) -> None:
 
-        content_blocks = [block for match in self.content_expression.find(block) for block in match.value]
+        block_scan = block_scan or BlockScan(block)
 
-        if not content_blocks:
-            for caption in self.caption_expression.find(block):
-                if caption.value and isinstance(caption.value, str):
-                    parent_tag.append(caption.value)
+        if not block_scan.content_blocks:
+            for caption in block_scan.captions:
+                if caption and isinstance(caption, str):
+                    parent_tag.append(caption)
                     return
 
-        for content in content_blocks:
+        for content in block_scan.content_blocks:
             if content['__typename'] == 'TextInline':
 
-                formats = content.get('formats') or []
-                formats.append({'__typename': 'TextFormat', 'text': content.get('text')})
-
                 nested_tag: Tag = self.b_soup.new_tag('root')
-                for current_format in formats:
+                innermost_tag = nested_tag
+                for current_format in content.get('formats') or []:
                     format_type = current_format['__typename']
 
                     if format_type == 'LinkFormat':
@@ -227,9 +230,190 @@ class NyTimesParser:
                     else:
                         raise Exception(f'Unknown format type: {format_type}')
 
-                    if descendants := list(nested_tag.descendants):
-                        descendants[-1].append(format_tag)
-                    else:
-                        nested_tag.append(format_tag)
+                    innermost_tag.append(format_tag)
+                    innermost_tag = format_tag
 
+                innermost_tag.append(self.b_soup.new_string(content.get('text')))
                 parent_tag.append(nested_tag.next)
+
+
+class NyTimesHtmlParser(NyTimesParser):
+    """
+    Walks the same blocks as :class:`NyTimesParser`, but writes the escaped HTML straight into a list of strings
+    instead of building a BeautifulSoup tree and prettifying it. The markup is the same, the tags and strings are
+    joined by the line breaks `prettify()` puts between them (not its indentation), so adjacent text runs, e.g. the
+    captions of the images of a grid, stay separated by whitespace as they were.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.parts: list[str] = []
+
+    def parse(self, news_html: str | bytes, encoding: str = 'utf-8') -> str:
+
+        news_json = get_script_json_fast(news_html, 'window.__preloadedData', encoding)
+        try:
+            article_blocks = news_json['initialData']['data']['article']['sprinkledBody']['content']
+        except (KeyError, TypeError):
+            return
+
+        self.parts = []
+        for _ in self.parse_blocks(article_blocks):
+            pass
+
+        content = '\n'.join(self.parts)
+        self.parts = []
+        return content
+
+    def parse_list_block(self, block: dict):
+        list_tag = 'ul' if block.get('style') == 'UNORDERED' else 'ol'
+
+        self.parts.append(f'<{list_tag}>')
+        for list_content in block['content']:
+            self.create_element_from_block('li', list_content)
+        self.parts.append(f'</{list_tag}>')
+        yield from ()
+
+    def parse_youtube_block(self, block: dict):
+        src = escape(f'https://www.youtube.com/embed/{block["youTubeId"]}')
+        self.parts.append(f'<iframe src="{src}"></iframe>')
+        yield from ()
+
+    def parse_rule_block(self, block: dict):
+        self.parts.append('<hr/>')
+        yield from ()
+
+    def parse_line_break_block(self, block: dict):
+        self.parts.append('<br/>')
+        yield from ()
+
+    def create_element_from_block(self, element_tag: str, block: dict, block_scan: 'BlockScan' = None) -> None:
+        if not block:
+            return
+
+        start = len(self.parts)
+        self.parts.append(f'<{element_tag}>')
+        has_text = self.parse_block_content(block, None, block_scan)
+        self.parts.append(f'</{element_tag}>')
+
+        # An empty caption is left out, the same as NyTimesParser.parse does with the figcaption tags
+        if element_tag == 'figcaption' and not has_text:
+            del self.parts[start:]
+
+    def parse_image_block(self, block: dict, parse_caption: bool = True):
+        if not block:
+            return
+
+        block_scan = BlockScan(block)
+        if not block_scan.has_image_url:
+            return
+
+        self.parts.append(f'<img src="{escape(block_scan.image_url)}"/>')
+        if parse_caption:
+            self.create_element_from_block('figcaption', block, block_scan)
+        yield from ()
+
+    def parse_block_content(self, block: dict, parent_tag: Tag, block_scan: 'BlockScan' = None) -> bool:
+        """
+        Writes the content of the block and returns whether any text was written.
+        """
+        block_scan = block_scan or BlockScan(block)
+
+        if not block_scan.content_blocks:
+            for caption in block_scan.captions:
+                if caption and isinstance(caption, str):
+                    self.parts.append(escape(caption, quote=False))
+                    return True
+            return False
+
+        has_text = False
+        for content in block_scan.content_blocks:
+            if content['__typename'] == 'TextInline':
+
+                closing_tags = []
+                for current_format in content.get('formats') or []:
+                    format_type = current_format['__typename']
+
+                    if format_type == 'LinkFormat':
+                        self.parts.append(f'<a href="{escape(current_format["url"])}">')
+                        closing_tags.append('</a>')
+
+                    elif format_type == 'BoldFormat':
+                        self.parts.append('<b>')
+                        closing_tags.append('</b>')
+
+                    elif format_type == 'ItalicFormat':
+                        self.parts.append('<em>')
+                        closing_tags.append('</em>')
+
+                    elif format_type == 'TextFormat':
+                        if text := current_format['text']:
+                            self.parts.append(escape(text, quote=False))
+                            has_text = True
+
+                    else:
+                        raise Exception(f'Unknown format type: {format_type}')
+
+                if text := content.get('text'):
+                    self.parts.append(escape(text, quote=False))
+                    has_text = True
+                self.parts.extend(reversed(closing_tags))
+
+        return has_text
+
+
+class BlockScan:
+    """
+    Everything the parser needs from a block, collected in a single pre-order walk over its subtree:
+        - content_blocks: the items of every `content` list (what `$..content` used to find)
+        - captions: every `caption`, followed by every `legacyHtmlCaption` (`$..caption | $..legacyHtmlCaption`)
+        - image_url: the first `crops[0].renditions[0].url` (`$..crops[0].renditions[0].url`)
+    """
+
+    __slots__ = ('content_blocks', 'captions', 'image_url', 'has_image_url', '_legacy_captions')
+
+    def __init__(self, block: dict):
+        self.content_blocks = []
+        self.captions = []
+        self.image_url = None
+        self.has_image_url = False
+        self._legacy_captions = []
+
+        self._walk(block)
+        self.captions.extend(self._legacy_captions)
+
+    def _walk(self, node: dict | list) -> None:
+        if isinstance(node, list):
+            for value in node:
+                if isinstance(value, (dict, list)):
+                    self._walk(value)
+            return
+
+        if 'content' in node:
+            self.content_blocks.extend(node['content'] or ())
+        if 'caption' in node:
+            self.captions.append(node['caption'])
+        if 'legacyHtmlCaption' in node:
+            self._legacy_captions.append(node['legacyHtmlCaption'])
+        if not self.has_image_url and 'crops' in node:
+            self._find_image_url(node['crops'])
+
+        for value in node.values():
+            if isinstance(value, (dict, list)):
+                self._walk(value)
+
+    def _find_image_url(self, crops: list) -> None:
+        try:
+            rendition = crops[0]['renditions'][0]
+        except (IndexError, KeyError, TypeError):
+            return
+
+        if isinstance(rendition, dict) and 'url' in rendition:
+            self.image_url = rendition['url']
+            self.has_image_url = True
+
+
+NYTIMES_PARSERS = {
+    'bs4': NyTimesParser,
+    'html': NyTimesHtmlParser,
+}
@@ -1,9 +1,16 @@
-from typing import Callable, Set, Union, Optional
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Set, Union, Optional
 
 from scrapy import Request
 from scrapy.crawler import Crawler
 from scrapy.exceptions import IgnoreRequest
 from scrapy.http.request import NO_CALLBACK
+from scrapy.statscollectors import StatsCollector
 from scrapy.utils.defer import maybe_deferred_to_future
 from scrapy_poet import PageObjectInputProvider
 from scrapy_poet.utils import (
@@ -32,14 +39,131 @@ class HttpClientEx(HttpClient):
         return await super().get(str(url), headers=headers, allow_status=allow_status)
 
 
+class HttpResponseCache:
+    """
+    Sits in front of the downloader of the additional requests of the page objects:
+        - identical requests (method, URL, headers, body and Zyte API parameters) in flight at the same time are
+          downloaded once, the others wait for the same response (single flight)
+        - the successful GET responses of the URLs matching a pattern of `ttls` are kept for its TTL (seconds), the
+          first matching pattern wins, in an LRU cache of at most `max_entries` responses
+    """
+
+    def __init__(self, stats: StatsCollector, ttls: dict[str, float], max_entries: int, coalescing: bool = True):
+        self.stats = stats
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls.items()]
+        self.max_entries = max_entries
+        self.coalescing = coalescing
+        self.in_flight: dict[bytes, asyncio.Future] = {}
+        # key -> (expires at, response), least recently used first
+        self.responses: OrderedDict[bytes, tuple[float, HttpResponse]] = OrderedDict()
+
+    @staticmethod
+    def request_key(request: Request) -> bytes:
+        key = hashlib.sha1()
+        key.update(request.method.encode())
+        key.update(request.url.encode())
+        for name, values in sorted(request.headers.items()):
+            key.update(name.lower() + b':' + b','.join(values) + b'\n')
+        key.update(request.body)
+        zyte_api_meta = {name: value for name, value in request.meta.items() if name.startswith('zyte_api')}
+        if zyte_api_meta:
+            key.update(json.dumps(zyte_api_meta, sort_keys=True, default=str).encode())
+        return key.digest()
+
+    def request_ttl(self, request: Request) -> float:
+        if request.method != 'GET':
+            return 0
+        for pattern, ttl in self.ttls:
+            if pattern.search(request.url):
+                return ttl
+        return 0
+
+    async def fetch(self, request: Request, download: Callable[[], Awaitable[HttpResponse]]) -> HttpResponse:
+        key = self.request_key(request)
+
+        if (ttl := self.request_ttl(request)) > 0:
+            if (cached := self.responses.get(key)) is not None:
+                expires_at, response = cached
+                if expires_at > time.monotonic():
+                    self.responses.move_to_end(key)
+                    self.stats.inc_value('http_client/cache_hits')
+                    return response
+                del self.responses[key]
+                self.stats.inc_value('http_client/cache_expired')
+            self.stats.inc_value('http_client/cache_misses')
+
+        if self.coalescing:
+            return await self.download_once(key, ttl, download)
+        return await self.download(key, ttl, download)
+
+    async def download(self, key: bytes, ttl: float, download: Callable[[], Awaitable[HttpResponse]]) -> HttpResponse:
+        response = await download()
+        self.stats.inc_value('http_client/downloads')
+        if ttl > 0 and 200 <= response.status < 300:
+            self.store(key, ttl, response)
+        return response
+
+    async def download_once(self, key: bytes, ttl: float,
+                            download: Callable[[], Awaitable[HttpResponse]]) -> HttpResponse:
+        """
+        Single flight: the first request of a key downloads it, the identical ones in flight wait for its response.
+        When that download is cancelled, one of the waiters downloads it instead of failing too.
+        """
+        while (in_flight := self.in_flight.get(key)) is not None:
+            self.stats.inc_value('http_client/coalesced')
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        # Marks the exception as retrieved when no other request was waiting for it
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self.in_flight[key] = future
+        try:
+            response = await self.download(key, ttl, download)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(response)
+        finally:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+        return response
+
+    def store(self, key: bytes, ttl: float, response: HttpResponse) -> None:
+        self.responses[key] = (time.monotonic() + ttl, response)
+        self.responses.move_to_end(key)
+        while len(self.responses) > self.max_entries:
+            self.responses.popitem(last=False)
+            self.stats.inc_value('http_client/cache_evictions')
+
+
 # Providers
 class HttpClientProviderEx(PageObjectInputProvider):
     """This class provides :class:`web_poet.HttpClient
     <web_poet.page_inputs.client.HttpClient>` instances.
+
+    The downloads go through a :class:`HttpResponseCache` shared by every page object of the crawl.
     """
 
     provided_classes = {HttpClientEx}
 
+    def __init__(self, injector):
+        super().__init__(injector)
+        settings = injector.crawler.settings
+        self.response_cache = HttpResponseCache(
+            injector.crawler.stats,
+            ttls=settings.getdict('HTTP_CLIENT_CACHE_TTLS'),
+            max_entries=settings.getint('HTTP_CLIENT_CACHE_MAX_ENTRIES'),
+            coalescing=settings.getbool('HTTP_CLIENT_COALESCING_ENABLED'),
+        )
+
     def __call__(self, to_provide: Set[Callable], crawler: Crawler):
         """Creates an :class:`web_poet.HttpClient
         <web_poet.page_inputs.client.HttpClient>` instance using Scrapy's
@@ -70,10 +194,11 @@ class HttpClientProviderEx(PageObjectInputProvider):
             if scrapy_request.method == "HEAD":
                 scrapy_request.meta["dont_redirect"] = True
 
-            deferred = download_func(scrapy_request)
-            deferred_or_future = maybe_deferred_to_future(deferred)
+            async def download() -> HttpResponse:
+                return scrapy_response_to_http_response(await maybe_deferred_to_future(download_func(scrapy_request)))
+
             try:
-                response = await deferred_or_future
+                response = await self.response_cache.fetch(scrapy_request, download)
             except IgnoreRequest as e:
                 # A Scrapy downloader middleware has caused the request to be
                 # ignored.
@@ -88,7 +213,7 @@ class HttpClientProviderEx(PageObjectInputProvider):
                 message = f"Additional request failed: {scrapy_request}"
                 raise HttpRequestError(message) from e
 
-            return scrapy_response_to_http_response(response)
+            return response
 
         return scrapy_downloader
 
@@ -0,0 +1,403 @@
+import abc
+import importlib.resources as pkg_resources
+import json
+import re
+from collections import Counter, defaultdict
+from html.entities import html5
+
+from bs4 import BeautifulSoup, NavigableString
+from lxml import etree
+
+from NewsScraper.utils import get_domain
+
+
+def load_remove_references() -> dict[str, list[re.Pattern]]:
+    remove_references_data = pkg_resources.read_text('NewsScraper.resources', 'remove_references.json')
+    remove_references_re = defaultdict(list)
+    for domain, references in json.loads(remove_references_data).items():
+        for reference in references:
+            compiled_reference_regex = re.compile(rf'\b{re.escape(reference)}\b', re.IGNORECASE)
+            remove_references_re[domain].append(compiled_reference_regex)
+    return remove_references_re
+
+
+class ContentSanitizer(abc.ABC):
+    """
+    Cleans up the article content before it is stored:
+        - the first image becomes the featured image, unless the article already has one
+        - links to the article's own domain and relative links are replaced with their text
+        - text nodes mentioning the source (remove_references.json) are removed
+    """
+
+    def __init__(self, remove_references_re: dict[str, list[re.Pattern]] = None):
+        self.remove_references_re = remove_references_re if remove_references_re is not None else load_remove_references()
+
+    @abc.abstractmethod
+    def sanitize(self, content: str, source_url: str, featured_image: str = None) -> tuple[str, str]:
+        """
+        Returns the sanitized content and the featured image.
+        """
+
+
+class Bs4ContentSanitizer(ContentSanitizer):
+
+    def sanitize(self, content: str, source_url: str, featured_image: str = None) -> tuple[str, str]:
+        content_bs = BeautifulSoup(content, 'html.parser')
+
+        if not featured_image and (img := content_bs.find('img')):
+            featured_image = img['src']
+
+        root_domain = get_domain(source_url)
+        for href in content_bs.find_all('a'):
+            href_domain = get_domain(href['href'])
+            if not href_domain or href_domain == root_domain:
+                href.replace_with(href.text)
+
+        for reference_re in self.remove_references_re.get(root_domain) or []:
+            for _string in list(content_bs.strings):  # type: NavigableString
+                if reference_re.search(_string):
+                    _string.replace_with('')
+
+        return str(content_bs), featured_image
+
+
+class LxmlContentSanitizer(ContentSanitizer):
+    """
+    Does the same as :class:`Bs4ContentSanitizer` in a single walk over an lxml tree, writing the output straight
+    into a list of strings.
+
+    The output is serialized the way BeautifulSoup does it (minimal entity substitution, ``<br/>`` style empty
+    elements, whitespace-joined multi-valued attributes), so both engines produce the same bytes.
+
+    libxml2 restructures misnested markup (``<p>`` around a ``<div>``, unclosed ``<li>`` or ``<option>``, a nested
+    ``<html>``) where html.parser keeps the tags as written. The content is therefore also scanned the way html.parser
+    builds its tree, and handed to :class:`Bs4ContentSanitizer` when the two trees differ. Content libxml2 parsed
+    without an error and with an end tag for every element is taken as is without the scan, it cannot have been
+    restructured.
+
+    Markup the two parsers read differently whatever the tree is goes straight to the fallback: raw text and RCDATA
+    elements (script, textarea, ...) left open, holding markup or references or closed without being opened,
+    attributes without a value or given twice, and character references which are not a complete named entity.
+    """
+
+    END_TAG_RE = re.compile(r'</([a-zA-Z][^\t\n\r\f />\x00]*)')
+    TAG_RE = re.compile(r'<(/?)([a-zA-Z][^\t\n\r\f />\x00]*)([^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*)>')
+    # Empty comments are left to the fallback, libxml2 reads them differently
+    COMMENT_RE = re.compile(r'<!--(?!-?>).+?-->', re.DOTALL)
+    # A tag, or a comment with the groups of TAG_RE unset
+    MARKUP_RE = re.compile(f'{COMMENT_RE.pattern}|{TAG_RE.pattern}', re.DOTALL)
+    ATTRIBUTE_RE = re.compile(r'([^\s"\'>/=]+)(\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]+))?')
+    ENTITY_RE = re.compile(r'&([a-zA-Z][a-zA-Z0-9]*)(;?)')
+    # Either parser reads these as text up to their end tag, but not the same tags, so only plain text agrees
+    RAW_TEXT_RE = re.compile(
+        r'<(script|style|textarea|title|xmp|iframe|noembed|noframes|noscript|plaintext)\b[^>]*>[^<&]*(</\1\s*>)?',
+        re.IGNORECASE,
+    )
+    RAW_TEXT_END_RE = re.compile(
+        r'</(?:script|style|textarea|title|xmp|iframe|noembed|noframes|noscript|plaintext)\b', re.IGNORECASE)
+    # Named references html.parser resolves without the semicolon, libxml2 resolves them as prefixes of longer names
+    LEGACY_ENTITIES = frozenset(name for name in html5 if not name.endswith(';'))
+
+    EMPTY_ELEMENT_TAGS = frozenset({
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param',
+        'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer',
+    })
+
+    # The text of these tags is neither escaped nor treated as a regular string by BeautifulSoup
+    CDATA_CONTAINING_TAGS = frozenset({'script', 'style'})
+    SPECIAL_STRING_TAGS = frozenset({'script', 'style', 'template', 'rt', 'rp'})
+
+    # BeautifulSoup collapses whitespace-only strings to a single newline or space, except inside these tags
+    PRESERVE_WHITESPACE_TAGS = frozenset({'pre', 'textarea'})
+    ASCII_SPACES = ' \n\t\x0c\r'
+
+    MULTI_VALUED_ATTRIBUTES = {
+        '*': {'class', 'accesskey', 'dropzone'},
+        'a': {'rel', 'rev'},
+        'link': {'rel', 'rev'},
+        'td': {'headers'},
+        'th': {'headers'},
+        'form': {'accept-charset'},
+        'object': {'archive'},
+        'area': {'rel'},
+        'icon': {'sizes'},
+        'iframe': {'sandbox'},
+        'output': {'for'},
+    }
+
+    def __init__(self, remove_references_re: dict[str, list[re.Pattern]] = None):
+        super().__init__(remove_references_re)
+        self.parser = etree.HTMLParser(remove_blank_text=False, remove_comments=False, remove_pis=False)
+        self.fallback = Bs4ContentSanitizer(self.remove_references_re)
+
+        # A string is removed if any of the references matches, so a single alternation does the same in one search
+        self.combined_references_re = {
+            domain: re.compile('|'.join(reference_re.pattern for reference_re in references_re), re.IGNORECASE)
+            for domain, references_re in self.remove_references_re.items() if references_re
+        }
+
+    def sanitize(self, content: str, source_url: str, featured_image: str = None) -> tuple[str, str]:
+        if self.needs_fallback(content):
+            return self.fallback.sanitize(content, source_url, featured_image)
+
+        # Without end tags of its own the wrapper cannot end up in a comment or the text of an element left open
+        document = etree.fromstring(f'<html><body>{content}', self.parser)
+        body = document.find('body') if document is not None else None
+        if body is None:
+            return '', featured_image
+        if not self.is_explicitly_closed(content, body) and (
+            self.tree_events(body) != self.html_parser_tree_events(content)
+        ):
+            return self.fallback.sanitize(content, source_url, featured_image)
+
+        root_domain = get_domain(source_url)
+        references_re = self.combined_references_re.get(root_domain)
+        find_image = not featured_image
+        preserve_whitespace = 0
+        parts = []
+
+        def write_string(text: str) -> None:
+            if not text:
+                return
+            if not preserve_whitespace:
+                text = self.collapse_whitespace(text)
+            if references_re is None or not references_re.search(text):
+                parts.append(text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'))
+
+        def write_element(element: etree.ElementBase) -> None:
+            nonlocal featured_image, find_image, preserve_whitespace
+
+            tag = element.tag
+            if not isinstance(tag, str):
+                if tag is etree.Comment:
+                    comment = element.text or ''
+                    parts.append(f'<!--{comment if preserve_whitespace else self.collapse_whitespace(comment)}-->')
+                write_string(element.tail)
+                return
+
+            if find_image and tag == 'img':
+                featured_image = element.get('src')
+                find_image = False
+
+            elif tag == 'a':
+                href_domain = get_domain(element.get('href', ''))
+                if not href_domain or href_domain == root_domain:
+                    if find_image and (img := element.find('.//img')) is not None:
+                        featured_image = img.get('src')
+                        find_image = False
+                    write_string(self.get_text(element, preserve_whitespace > 0))
+                    write_string(element.tail)
+                    return
+
+            parts.append('<')
+            parts.append(tag)
+            for name, value in sorted(element.items()):
+                parts.append(' ')
+                parts.append(name)
+                parts.append('=')
+                parts.append(self.quote_attribute(tag, name, value))
+
+            if tag in self.EMPTY_ELEMENT_TAGS and not element.text and not len(element):
+                parts.append('/>')
+
+            else:
+                parts.append('>')
+                if tag in self.PRESERVE_WHITESPACE_TAGS:
+                    preserve_whitespace += 1
+
+                if tag in self.SPECIAL_STRING_TAGS:
+                    if text := element.text:
+                        if not preserve_whitespace:
+                            text = self.collapse_whitespace(text)
+                        parts.append(text if tag in self.CDATA_CONTAINING_TAGS else self.escape(text))
+                else:
+                    write_string(element.text)
+
+                for child in element:
+                    write_element(child)
+
+                if tag in self.PRESERVE_WHITESPACE_TAGS:
+                    preserve_whitespace -= 1
+                parts.append('</')
+                parts.append(tag)
+                parts.append('>')
+
+            write_string(element.tail)
+
+        write_string(body.text)
+        for child in body:
+            write_element(child)
+
+        return ''.join(parts), featured_image
+
+    def needs_fallback(self, content: str) -> bool:
+        raw_text_elements = 0
+        for match in self.RAW_TEXT_RE.finditer(content):
+            if not match.group(2):
+                return True
+            raw_text_elements += 1
+        if len(self.RAW_TEXT_END_RE.findall(content)) != raw_text_elements:
+            return True
+
+        if '&' in content:
+            for name, semicolon in self.ENTITY_RE.findall(content):
+                if semicolon:
+                    if f'{name};' not in html5:
+                        return True
+                elif any(name[:length] in self.LEGACY_ENTITIES for length in range(1, len(name) + 1)):
+                    return True
+
+        for end, _, attributes in self.TAG_RE.findall(content):
+            if end or not attributes.strip(' \t\n\r\f/'):
+                continue
+            names = set()
+            for name, value in self.ATTRIBUTE_RE.findall(attributes):
+                name = name.lower()
+                if not value or name in names:
+                    return True
+                names.add(name)
+        return False
+
+    def is_explicitly_closed(self, content: str, body: etree.ElementBase) -> bool:
+        """
+        True if libxml2 reported no error for the content just parsed, the content has no comment or declaration and
+        every element (but the empty ones) has its own end tag in the content, so none was closed implicitly.
+        """
+        if len(self.parser.error_log) or '<!' in content or '<?' in content:
+            return False
+
+        end_tags = Counter(tag.lower() for tag in self.END_TAG_RE.findall(content))
+        elements = Counter(
+            element.tag for element in body.iterdescendants(etree.Element) if element.tag not in self.EMPTY_ELEMENT_TAGS
+        )
+        return end_tags == elements
+
+    def html_parser_tree_events(self, content: str) -> list[tuple] | None:
+        """
+        The tree html.parser and BeautifulSoup build from the content, as the events of :meth:`tree_events`: an end tag
+        closes the innermost open element with its name (and the ones inside it). None for markup the scan does not
+        follow (declarations, processing instructions) and for end tags without an open element, html.parser ignores
+        them but still splits the text around them.
+        """
+        if '<!' in content or '<?' in content:
+            stripped = self.COMMENT_RE.sub('', content)
+            if '<!' in stripped or '<?' in stripped:
+                return None
+
+        events = []
+        open_tags = []
+        open_indexes = [-1]
+        element_index = 0
+        position = 0
+
+        while match := self.MARKUP_RE.search(content, position):
+            if match.start() > position and events[-1:] != [text := ('text', open_indexes[-1])]:
+                events.append(text)
+            position = match.end()
+
+            end, tag, attributes = match.groups()
+            if tag is None:
+                events.append(('comment', open_indexes[-1]))
+                continue
+
+            tag = tag.lower()
+            if end:
+                if tag not in open_tags:
+                    return None
+                depth = len(open_tags) - open_tags[::-1].index(tag) - 1
+                del open_tags[depth:]
+                del open_indexes[depth + 1:]
+                continue
+
+            events.append(('start', tag, len(open_tags)))
+            if tag in self.EMPTY_ELEMENT_TAGS or attributes.endswith('/'):
+                element_index += 1
+                continue
+
+            open_tags.append(tag)
+            open_indexes.append(element_index)
+            element_index += 1
+
+            # The content of script and style is raw text up to their closing tag
+            if tag in self.CDATA_CONTAINING_TAGS:
+                end_match = re.compile(f'</{tag}', re.IGNORECASE).search(content, position)
+                end_position = end_match.start() if end_match else len(content)
+                if end_position > position:
+                    events.append(('text', open_indexes[-1]))
+                position = end_position
+
+        if position < len(content) and events[-1:] != [text := ('text', open_indexes[-1])]:
+            events.append(text)
+        return events
+
+    @staticmethod
+    def tree_events(body: etree.ElementBase) -> list[tuple]:
+        """
+        The elements of the body in document order, as ('start', tag, depth), and the text and comments between them,
+        as ('text', index of the element containing it) and ('comment', index), -1 being the body.
+        """
+        events = []
+        element_index = 0
+
+        def add_text(text: str, parent_index: int) -> None:
+            if text and events[-1:] != [('text', parent_index)]:
+                events.append(('text', parent_index))
+
+        def add_element(element: etree.ElementBase, depth: int, parent_index: int) -> None:
+            nonlocal element_index
+            if isinstance(element.tag, str):
+                index = element_index
+                element_index += 1
+                events.append(('start', element.tag, depth))
+                add_text(element.text, index)
+                for child in element:
+                    add_element(child, depth + 1, index)
+            elif element.tag is etree.Comment:
+                events.append(('comment', parent_index))
+            add_text(element.tail, parent_index)
+
+        add_text(body.text, -1)
+        for child in body:
+            add_element(child, 0, -1)
+        return events
+
+    def collapse_whitespace(self, text: str) -> str:
+        if not text or text.strip(self.ASCII_SPACES):
+            return text
+        return '\n' if '\n' in text else ' '
+
+    @staticmethod
+    def escape(text: str) -> str:
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    def quote_attribute(self, tag: str, name: str, value: str) -> str:
+        if name in self.MULTI_VALUED_ATTRIBUTES['*'] or name in self.MULTI_VALUED_ATTRIBUTES.get(tag, ()):
+            value = ' '.join(value.split())
+
+        value = self.escape(value)
+        if '"' not in value:
+            return f'"{value}"'
+        if "'" not in value:
+            return f"'{value}'"
+        return '"' + value.replace('"', '&quot;') + '"'
+
+    def get_text(self, element: etree.ElementBase, preserve_whitespace: bool = False) -> str:
+        """
+        The text of the element the way BeautifulSoup's ``Tag.text`` returns it, comments and the content of
+        script-like tags are skipped.
+        """
+        preserve_children_whitespace = preserve_whitespace or element.tag in self.PRESERVE_WHITESPACE_TAGS
+
+        texts = [element.text if preserve_children_whitespace else self.collapse_whitespace(element.text or '')]
+        for child in element:
+            if isinstance(child.tag, str) and child.tag not in self.SPECIAL_STRING_TAGS:
+                texts.append(self.get_text(child, preserve_children_whitespace))
+            if child.tail:
+                texts.append(child.tail if preserve_children_whitespace else self.collapse_whitespace(child.tail))
+        return ''.join(texts)
+
+
+SANITIZERS = {
+    'bs4': Bs4ContentSanitizer,
+    'lxml': LxmlContentSanitizer,
+}
@@ -0,0 +1,455 @@
+import json
+import logging
+import os
+import socket
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Iterator, NamedTuple
+
+from scrapy.crawler import Crawler
+from scrapy.settings import Settings
+from scrapy.statscollectors import StatsCollector
+from sqlalchemy import select, update, or_
+from sqlalchemy.exc import SQLAlchemyError
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+
+import NewsScraper.newsdb.models as models
+
+logger = logging.getLogger(__name__)
+
+
+def utcnow() -> datetime:
+    # The DateTime columns hold naive UTC times
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class SourceRow(NamedTuple):
+    source_id: int
+    source_url: str
+    is_rss: bool
+    category_id: int | None
+    city_id: int | None
+
+
+class LeaseClaim(NamedTuple):
+    candidates: int
+    source_ids: list[int]
+    sources: list[SourceRow]
+
+
+SOURCE_COLUMNS = [getattr(models.ScraperSource, column) for column in SourceRow._fields]
+
+
+class SourceShard:
+    """
+    The share of the scraper sources a worker crawls, this one is every source.
+
+    The sources are read in pages of `page_size` by source_id, only the columns of SourceRow, each page in its own
+    short session. With a `snapshot_path` the source list is saved there after every complete read, and used instead
+    of the database when the first page fails or takes longer than `snapshot_timeout` seconds.
+
+    Articles stay deduplicated across shards because they are keyed by news_hash: an article reachable from sources
+    of two shards is upserted twice into the same row, and each worker checks the database for the hashes its own
+    index does not cover.
+    """
+
+    name = 'all'
+
+    def __init__(self, stats: StatsCollector, page_size: int = 500, snapshot_path: str | Path = None,
+                 snapshot_timeout: float = 10):
+        self.stats = stats
+        self.page_size = max(page_size, 1)
+        self.snapshot_path = Path(snapshot_path) if snapshot_path else None
+        self.snapshot_timeout = snapshot_timeout
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        return cls(crawler.stats, **cls.source_options(crawler.settings))
+
+    @staticmethod
+    def source_options(settings: Settings) -> dict:
+        return {
+            'page_size': settings.getint('SOURCE_PAGE_SIZE'),
+            'snapshot_path': settings.get('SOURCE_SNAPSHOT_PATH') if settings.getbool('SOURCE_SNAPSHOT_ENABLED') else None,
+            'snapshot_timeout': settings.getfloat('SOURCE_SNAPSHOT_TIMEOUT'),
+        }
+
+    def start(self, schedule_sources: Callable[[list[SourceRow]], None]) -> None:
+        """
+        `schedule_sources` takes the sources the shard finds after start_requests, the shards here read them all in
+        iter_sources() and never call it.
+        """
+        self.stats.set_value('shard/mode', self.name)
+
+    def stop(self, finished: bool) -> Deferred | None:
+        pass
+
+    def source_done(self, source_id: int) -> None:
+        pass
+
+    def keep_alive(self) -> bool:
+        """ Whether the spider has to stay open while idle, because more sources are coming. """
+        return False
+
+    def sources_query(self):
+        return select(*SOURCE_COLUMNS).order_by(models.ScraperSource.source_id)
+
+    def fetch_page(self, after_source_id: int) -> list[SourceRow]:
+        query = self.sources_query().where(models.ScraperSource.source_id > after_source_id).limit(self.page_size)
+        with models.Session() as session:
+            return [SourceRow(*row) for row in session.execute(query)]
+
+    def fetch_first_page(self) -> list[SourceRow]:
+        if self.snapshot_path is None or self.snapshot_timeout <= 0:
+            return self.fetch_page(0)
+
+        thread_pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            return thread_pool.submit(self.fetch_page, 0).result(timeout=self.snapshot_timeout)
+        finally:
+            thread_pool.shutdown(wait=False)
+
+    def iter_sources(self) -> Iterator[SourceRow]:
+        try:
+            page = self.fetch_first_page()
+        except (SQLAlchemyError, TimeoutError) as ex:
+            if (snapshot := self.load_snapshot()) is None:
+                raise
+            logger.warning(f'Reading the sources from {self.snapshot_path}, the database failed: {ex!r}')
+            self.stats.set_value('shard/snapshot_used', 1)
+            page = None
+
+        if page is None:
+            for source in snapshot:
+                self.stats.inc_value('shard/sources')
+                yield source
+            return
+
+        sources = []
+        while page:
+            for source in page:
+                self.stats.inc_value('shard/sources')
+                yield source
+
+            if self.snapshot_path is not None:
+                sources += page
+            if len(page) < self.page_size:
+                break
+            page = self.fetch_page(page[-1].source_id)
+
+        if self.snapshot_path is not None:
+            self.save_snapshot(sources)
+
+    def load_snapshot(self) -> list[SourceRow] | None:
+        if self.snapshot_path is None or not self.snapshot_path.exists():
+            return None
+        snapshot = json.loads(self.snapshot_path.read_text(encoding='utf-8'))
+        return [SourceRow(*source) for source in snapshot['sources']]
+
+    def save_snapshot(self, sources: list[SourceRow]) -> None:
+        temp_path = self.snapshot_path.with_name(f'{self.snapshot_path.name}.tmp')
+        temp_path.write_text(json.dumps({
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'sources': sources,
+        }), encoding='utf-8')
+        os.replace(temp_path, self.snapshot_path)
+
+
+class ModuloSourceShard(SourceShard):
+    """
+    Static assignment: worker SHARD_INDEX of SHARD_COUNT crawls the sources whose source_id modulo SHARD_COUNT is
+    SHARD_INDEX. No coordination is needed, but a worker which dies leaves its share uncrawled.
+    """
+
+    name = 'modulo'
+
+    def __init__(self, stats: StatsCollector, index: int, count: int, **source_options):
+        super().__init__(stats, **source_options)
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f'Invalid shard {index} of {count}')
+        self.index = index
+        self.count = count
+
+        # Each shard keeps the snapshot of its own share
+        if self.snapshot_path is not None:
+            self.snapshot_path = self.snapshot_path.with_stem(f'{self.snapshot_path.stem}-{index}-of-{count}')
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        return cls(crawler.stats, crawler.settings.getint('SHARD_INDEX'), crawler.settings.getint('SHARD_COUNT'),
+                   **cls.source_options(crawler.settings))
+
+    def start(self, schedule_sources: Callable[[list[SourceRow]], None]) -> None:
+        super().start(schedule_sources)
+        logger.info(f'Crawling shard {self.index} of {self.count}')
+
+    def sources_query(self):
+        return super().sources_query().where(models.ScraperSource.source_id % self.count == self.index)
+
+
+class LeaseSourceShard(SourceShard):
+    """
+    Dynamic assignment through the scraper_source_lease table: the worker claims SHARD_LEASE_BATCH_SIZE sources at a
+    time and claims the next batch once half of the feeds of the previous one are done, so faster workers take more
+    of the sources. The claims need the database, there is no snapshot.
+
+    A claim is a conditional UPDATE of the free or expired leases followed by reading back the rows carrying the
+    claim's id, the database row locks decide which worker wins a source. The leases last SHARD_LEASE_TTL seconds
+    and are renewed every SHARD_LEASE_HEARTBEAT seconds, the sources of a worker which dies are claimed by the others
+    once its leases expire. On close the leases are released; when the run finished the sources are marked as
+    crawled and are not claimed again for SHARD_LEASE_MIN_INTERVAL seconds.
+
+    The database calls run in the reactor's thread pool like the pipeline's, the claimed sources are handed to the
+    spider through the `schedule_sources` callback instead of iter_sources(). A failed heartbeat is logged and tried
+    again on the next beat, a claim is given up after CLAIM_RETRIES consecutive failures.
+    """
+
+    name = 'lease'
+
+    CLAIM_RETRIES = 3
+
+    def __init__(self, stats: StatsCollector, worker_id: str, ttl: int, heartbeat_interval: int, batch_size: int,
+                 min_interval: int):
+        super().__init__(stats)
+        self.worker_id = worker_id
+        self.ttl = timedelta(seconds=ttl)
+        self.heartbeat_interval = heartbeat_interval
+        self.batch_size = batch_size
+        self.min_interval = timedelta(seconds=min_interval)
+        self.source_ids: set[int] = set()
+        self.pending_source_ids: set[int] = set()
+        self.heartbeat_loop: LoopingCall = None
+        self.schedule_sources: Callable[[list[SourceRow]], None] = None
+        self.claiming: Deferred = None
+        self.claim_errors = 0
+        self.leases_created = False
+        self.exhausted = False
+        self.stopping = False
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        settings = crawler.settings
+        return cls(
+            crawler.stats,
+            worker_id=settings.get('SHARD_WORKER_ID') or f'{socket.gethostname()}:{os.getpid()}',
+            ttl=settings.getint('SHARD_LEASE_TTL'),
+            heartbeat_interval=settings.getint('SHARD_LEASE_HEARTBEAT'),
+            batch_size=settings.getint('SHARD_LEASE_BATCH_SIZE'),
+            min_interval=settings.getint('SHARD_LEASE_MIN_INTERVAL'),
+        )
+
+    def start(self, schedule_sources: Callable[[list[SourceRow]], None]) -> None:
+        super().start(schedule_sources)
+        logger.info(f'Claiming sources as worker {self.worker_id}')
+        self.schedule_sources = schedule_sources
+
+        self.claim_more()
+
+        self.heartbeat_loop = LoopingCall(self.heartbeat)
+        self.heartbeat_loop.start(self.heartbeat_interval, now=False)
+
+    def stop(self, finished: bool) -> Deferred:
+        self.stopping = True
+        if self.heartbeat_loop and self.heartbeat_loop.running:
+            self.heartbeat_loop.stop()
+
+        # The sources of a claim still running are released with the others
+        released = self.claiming if self.claiming is not None else succeed(None)
+        released.addCallback(lambda _: self.release_leases(finished))
+        return released
+
+    def iter_sources(self) -> Iterator[SourceRow]:
+        return iter(())
+
+    def source_done(self, source_id: int) -> None:
+        self.pending_source_ids.discard(source_id)
+        if len(self.pending_source_ids) <= self.batch_size // 2:
+            self.claim_more()
+
+    def keep_alive(self) -> bool:
+        self.claim_more()
+        return self.claiming is not None
+
+    def claim_more(self) -> None:
+        if self.claiming is not None or self.exhausted or self.stopping:
+            return
+        self.claiming = deferToThread(self.claim)
+        self.claiming.addCallbacks(self.sources_claimed, self.claim_failed)
+
+    def sources_claimed(self, claim: LeaseClaim | None) -> None:
+        self.claiming = None
+        self.claim_errors = 0
+        if claim is None:
+            self.exhausted = True
+            return
+
+        self.source_ids.update(claim.source_ids)
+        self.stats.inc_value('shard/claims')
+        self.stats.inc_value('shard/claimed_sources', len(claim.source_ids))
+        self.stats.inc_value('shard/claim_races', claim.candidates - len(claim.source_ids))
+        if self.stopping:
+            return
+
+        # Other workers won all of the candidates
+        if not claim.sources:
+            self.claim_more()
+            return
+
+        self.pending_source_ids.update(source.source_id for source in claim.sources)
+        self.stats.inc_value('shard/sources', len(claim.sources))
+        self.schedule_sources(claim.sources)
+
+    def claim_failed(self, failure: Failure) -> None:
+        self.claiming = None
+        self.claim_errors += 1
+        self.stats.inc_value('shard/claim_errors')
+        if self.claim_errors < self.CLAIM_RETRIES:
+            logger.warning(f'Failed to claim sources, trying again: {failure.value!r}')
+            return
+
+        logger.error(f'Failed to claim sources {self.claim_errors} times, giving up: {failure.value!r}')
+        self.exhausted = True
+
+    def create_leases(self) -> None:
+        with models.Session() as session:
+            new_source_ids = session.scalars(
+                select(models.ScraperSource.source_id).where(~models.ScraperSource.source_id.in_(
+                    select(models.ScraperSourceLease.source_id)
+                ))
+            ).all()
+            if not new_source_ids:
+                return
+
+            # Another worker may be creating the same leases, the upsert leaves its rows as they are
+            session.execute(models.upsert(
+                session,
+                models.ScraperSourceLease.__table__,
+                [{'source_id': source_id} for source_id in new_source_ids],
+                index_elements=['source_id'],
+                update_columns=['source_id'],
+            ))
+            session.commit()
+
+    def claimable(self, now: datetime):
+        lease = models.ScraperSourceLease
+        return (
+            or_(lease.worker_id.is_(None), lease.expires_at < now),
+            or_(lease.crawled_at.is_(None), lease.crawled_at < now - self.min_interval),
+        )
+
+    def claim(self) -> LeaseClaim | None:
+        """
+        Runs in a thread. Returns the sources claimed, none when other workers won all of them, or None when no
+        source is left to claim.
+        """
+        if not self.leases_created:
+            self.create_leases()
+            self.leases_created = True
+
+        lease = models.ScraperSourceLease
+        now = utcnow()
+        claim_id = uuid.uuid4().hex
+
+        with models.Session() as session:
+            candidate_ids = session.scalars(
+                select(lease.source_id).where(*self.claimable(now)).order_by(lease.source_id).limit(self.batch_size)
+            ).all()
+            if not candidate_ids:
+                return None
+
+            session.execute(
+                update(lease)
+                .where(lease.source_id.in_(candidate_ids), *self.claimable(now))
+                .values(worker_id=self.worker_id, claim_id=claim_id, expires_at=now + self.ttl)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            claimed_ids = session.scalars(select(lease.source_id).where(lease.claim_id == claim_id)).all()
+
+            sources = []
+            if claimed_ids:
+                query = self.sources_query().where(models.ScraperSource.source_id.in_(claimed_ids))
+                sources = [SourceRow(*row) for row in session.execute(query)]
+
+        return LeaseClaim(len(candidate_ids), claimed_ids, sources)
+
+    def heartbeat(self) -> Deferred | None:
+        if not self.source_ids:
+            return None
+
+        # A failed renewal must not stop the loop, the next beat tries again before the leases expire
+        renewed = deferToThread(self.renew_leases)
+        renewed.addCallback(self.leases_renewed, set(self.source_ids))
+        renewed.addErrback(self.heartbeat_failed)
+        return renewed
+
+    def renew_leases(self) -> set[int]:
+        lease = models.ScraperSourceLease
+        with models.Session() as session:
+            session.execute(
+                update(lease)
+                .where(lease.worker_id == self.worker_id)
+                .values(expires_at=utcnow() + self.ttl)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            return set(session.scalars(select(lease.source_id).where(lease.worker_id == self.worker_id)))
+
+    def leases_renewed(self, held_ids: set[int], expected_ids: set[int]) -> None:
+        # A heartbeat still running on close reads the leases the release just freed
+        if self.stopping:
+            return
+
+        # Leases which expired before the heartbeat (e.g. a long pause) may have been claimed by another worker
+        if lost_ids := expected_ids - held_ids:
+            logger.warning(f'Lost the leases of {len(lost_ids)} sources')
+            self.stats.inc_value('shard/leases_lost', len(lost_ids))
+            self.source_ids -= lost_ids
+
+    def heartbeat_failed(self, failure: Failure) -> None:
+        logger.warning(f'Failed to renew the leases: {failure.value!r}')
+        self.stats.inc_value('shard/heartbeat_errors')
+
+    def release_leases(self, finished: bool) -> Deferred | None:
+        if not self.source_ids:
+            return None
+        released = deferToThread(self.release, finished)
+        released.addCallback(self.leases_released)
+        return released
+
+    def release(self, finished: bool) -> None:
+        lease = models.ScraperSourceLease
+        values = {'worker_id': None, 'claim_id': None, 'expires_at': None}
+        # The sources of an interrupted run can be claimed again right away
+        if finished:
+            values['crawled_at'] = utcnow()
+
+        with models.Session() as session:
+            session.execute(
+                update(lease)
+                .where(lease.worker_id == self.worker_id)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+
+    def leases_released(self, _) -> None:
+        logger.info(f'Released the leases of {len(self.source_ids)} sources')
+        self.stats.set_value('shard/released', len(self.source_ids))
+        self.source_ids.clear()
+
+
+SOURCE_SHARDS = {
+    None: SourceShard,
+    'modulo': ModuloSourceShard,
+    'lease': LeaseSourceShard,
+}
+
+
+def build_source_shard(crawler: Crawler) -> SourceShard:
+    return SOURCE_SHARDS[crawler.settings.get('SHARDING_MODE') or None].from_crawler(crawler)
@@ -1,14 +1,27 @@
+import calendar
+import hashlib
+import math
+import time
+from datetime import datetime, timezone
 from typing import Iterable, Any
 
 import scrapy
-from scrapy import Request
+from scrapy import Request, signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.http import Response
 from scrapy.utils.defer import maybe_deferred_to_future
+from sqlalchemy import select
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
 from web_poet import ApplyRule
 
 import NewsScraper.newsdb.models as models
+from NewsScraper.extensions import record_stage, record_stage_since
+from NewsScraper.dedup import NewsHashIndex, BloomNewsHashIndex, NearDuplicateIndex, from_signed64
+from NewsScraper.items import ArticleItem
 from NewsScraper.poet_pages.base_pages import ArticlePage, ArticleResultsPage
 from NewsScraper.poet_pages.nytimes_pages import NyTimesArticlePage, NyTimesRssPage
+from NewsScraper.sharding import SourceRow, SourceShard, build_source_shard
 
 
 class BaseNewsSpider(scrapy.Spider):
@@ -21,49 +34,472 @@ class BaseNewsSpider(scrapy.Spider):
         ]
     }
 
+    news_hash_index: NewsHashIndex = None
+    source_states: dict[int, dict] = None
+    changed_source_ids: set[int] = None
+    advanced_source_ids: set[int] = None
+    failed_source_ids: set[int] = None
+    source_shard: SourceShard = None
+    requested_hashes: set[str] = None
+    near_duplicate_index: NearDuplicateIndex = None
+    startup_started: float = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(spider.item_error, signal=signals.item_error)
+        return spider
+
     def start_requests(self) -> Iterable[Request]:
+        self.startup_started = time.perf_counter()
 
-        models.init_db(self.settings.get('MYSQL_CONNECTION_STRING'))
+        self.init_db()
+        self.crawler.stats.set_value('startup/init_db_seconds', round(time.perf_counter() - self.startup_started, 3))
 
-        with models.Session() as session:
-            for source in session.query(models.ScraperSource).all():
-                yield Request(
-                    url=source.source_url,
-                    cb_kwargs={
-                        'source': {
-                            'category_id': source.category_id,
-                            'city_id': source.city_id,
-                        }
-                    },
-                    meta={'zyte_api_automap': False} if source.is_rss else {},
-                    callback=self.parse_article_results
-                )
+        self.source_shard = build_source_shard(self.crawler)
+        self.source_shard.start(self.schedule_sources)
+
+        for source in self.source_shard.iter_sources():
+            yield self.source_request(source)
+
+    def schedule_sources(self, sources: list[SourceRow]) -> None:
+        for source in sources:
+            self.crawler.engine.crawl(self.source_request(source))
+
+    def spider_idle(self) -> None:
+        # The lease shard hands over its sources after start_requests, the spider waits for them
+        if self.source_shard is not None and self.source_shard.keep_alive():
+            raise DontCloseSpider
+
+    def source_request(self, source: SourceRow) -> Request:
+        if self.startup_started is not None:
+            self.crawler.stats.set_value('startup/time_to_first_request_seconds',
+                                         round(time.perf_counter() - self.startup_started, 3))
+            self.startup_started = None
+
+        meta = {'zyte_api_automap': False} if source.is_rss else {}
+        headers = {}
+        page_params = {
+            'feed_engine': self.settings.get('FEED_ENGINE'),
+            'news_hash_mode': self.settings.get('NEWS_HASH_MODE'),
+        }
+
+        if source.is_rss and self.settings.getbool('SOURCE_CONDITIONAL_REQUESTS_ENABLED'):
+            source_state = self.source_states.get(source.source_id, {})
+            if source_state.get('etag'):
+                headers['If-None-Match'] = source_state['etag']
+            if source_state.get('last_modified'):
+                headers['If-Modified-Since'] = source_state['last_modified']
+            meta['handle_httpstatus_list'] = [304]
+
+        if self.settings.getbool('SOURCE_WATERMARK_ENABLED'):
+            watermark = self.source_states.get(source.source_id, {}).get('watermark')
+            if watermark is not None:
+                page_params['watermark'] = watermark - self.settings.getint('SOURCE_WATERMARK_MARGIN')
+
+        meta['page_params'] = page_params
+
+        return Request(
+            url=source.source_url,
+            headers=headers,
+            cb_kwargs={
+                'source': {
+                    'source_id': source.source_id,
+                    'is_rss': source.is_rss,
+                    'category_id': source.category_id,
+                    'city_id': source.city_id,
+                }
+            },
+            meta=meta,
+            priority=self.settings.getint('FEED_REQUEST_PRIORITY'),
+            callback=self.parse_article_results,
+            errback=self.source_failed,
+        )
+
+    def source_failed(self, failure: Failure) -> None:
+        self.logger.warning(f'Failed to fetch {failure.request.url}: {failure.value!r}')
+        self.source_shard.source_done(failure.request.cb_kwargs['source']['source_id'])
 
     def parse_article_results(self, response: Response, article_results_page: ArticleResultsPage, **kwargs: Any) -> Any:
-        with models.Session() as session:
+        record_stage_since('injection', response.meta)
+        self.source_shard.source_done(kwargs['source']['source_id'])
+        if self.is_source_unchanged(response, kwargs['source']['source_id']):
+            return
+
+        started = time.perf_counter()
+        articles = list(article_results_page.parse_articles())
+        record_stage('parse_articles', time.perf_counter() - started)
+        stored_hashes = self.find_stored_hashes(articles)
+
+        for article in articles:
+
+            if not stored_hashes.isdisjoint(self.article_hashes(article)):
+                continue
+
+            # The same article under another URL (tracking parameters) or from another source of this run
+            if article['news_hash'] in self.requested_hashes:
+                self.crawler.stats.inc_value('news_hash/duplicate_requests')
+                continue
+
+            if self.is_near_duplicate_title(article):
+                continue
+            self.requested_hashes.add(article['news_hash'])
 
-            for article in article_results_page.parse_articles():
+            article['source_id'] = kwargs['source']['source_id']
+            article['journalist_id'] = 1
+            article['category_id'] = kwargs['source']['category_id']
+            article['city_id'] = kwargs['source']['city_id']
 
-                result = session.query(models.Article.article_id).filter(models.Article.news_hash == article['news_hash']).first()
-                if result is not None:
-                    continue
+            yield self.article_request(article)
 
-                article['journalist_id'] = 1
-                article['category_id'] = kwargs['source']['category_id']
-                article['city_id'] = kwargs['source']['city_id']
+    async def parse_article(self, response: scrapy.http.Response, article_page: ArticlePage, **kwargs):
+        record_stage_since('injection', response.meta)
 
-                yield Request(
-                    url=article['source_url'],
-                    cb_kwargs={
-                        'init_item': article,
-                    },
-                    callback=self.parse_article
-                )
+        started = time.perf_counter()
+        try:
+            item = await article_page.to_item()
+        except Exception:
+            self.mark_source_failed(kwargs['init_item'].get('source_id'))
+            raise
+        record_stage('to_item', time.perf_counter() - started)
+        yield item
 
-    def parse_article(self, response: scrapy.http.Response, article_page: ArticlePage, **kwargs):
-        yield article_page.to_item()
+    def init_db(self) -> None:
+        # The text storage never writes the compressed content column
+        unused_columns = [] if self.settings.get('ARTICLE_CONTENT_STORAGE') == 'compressed' else ['articles.content_body']
+        models.init_db(self.settings.get('MYSQL_CONNECTION_STRING'), schema_check=self.settings.get('DB_SCHEMA_CHECK'),
+                       unused_columns=unused_columns, **self.engine_options())
+        if self.settings.getbool('MYSQL_ASYNC_ENABLED'):
+            models.init_async_db(self.settings.get('MYSQL_ASYNC_CONNECTION_STRING'), **self.engine_options())
+        self.news_hash_index = self.load_news_hash_index()
+        self.source_states = self.load_source_states()
+        self.changed_source_ids = set()
+        self.advanced_source_ids = set()
+        self.failed_source_ids = set()
+        self.requested_hashes = set()
+        if self.settings.getbool('NEAR_DUPLICATE_ENABLED'):
+            self.near_duplicate_index = self.load_near_duplicate_index()
+
+    def article_request(self, article: ArticleItem) -> Request:
+        return Request(
+            url=article['source_url'],
+            cb_kwargs={
+                'init_item': article,
+            },
+            meta={
+                'page_params': {
+                    'parser_backend': self.settings.get('NYTIMES_PARSER_BACKEND'),
+                },
+                'article_created_at': article.get('created_at'),
+            },
+            priority=self.article_priority(article),
+            callback=self.parse_article,
+            errback=self.article_failed,
+        )
+
+    def article_failed(self, failure: Failure) -> None:
+        self.logger.warning(f'Failed to fetch {failure.request.url}: {failure.value!r}')
+        self.mark_source_failed(failure.request.cb_kwargs['init_item'].get('source_id'))
+
+    def item_error(self, item: ArticleItem, response: Response, spider: scrapy.Spider, failure: Failure) -> None:
+        # A pipeline raised, the article is not stored
+        self.mark_source_failed(item.get('source_id'))
+
+    def mark_source_failed(self, source_id: int | None) -> None:
+        """
+        An article of the source was not stored, so the state of the source is not saved: the next run fetches the
+        feed again and does not skip the article as below the watermark.
+        """
+        if source_id is not None and source_id not in self.failed_source_ids:
+            self.failed_source_ids.add(source_id)
+            self.crawler.stats.inc_value('source_state/failed_sources')
+
+    def article_priority(self, article: ArticleItem) -> int:
+        """
+        Newer articles are fetched first. The source and category weights (in minutes) make their articles count
+        as that much newer. The ages are bucketed on a log scale to keep the number of scheduler queues small: the
+        first bucket is ARTICLE_PRIORITY_BUCKET_MINUTES wide and each one after it ARTICLE_PRIORITY_BUCKET_GROWTH
+        times wider, 11 buckets for a week with the defaults.
+        """
+        if not self.settings.getbool('ARTICLE_PRIORITY_ENABLED'):
+            return 0
+
+        max_age_minutes = self.settings.getint('ARTICLE_PRIORITY_MAX_AGE') / 60
+        created_at = article.get('created_at')
+        age_minutes = (time.time() - created_at) / 60 if created_at is not None else max_age_minutes
+
+        weight = (
+            self.priority_weights('ARTICLE_PRIORITY_SOURCE_WEIGHTS').get(article.get('source_id'), 0)
+            + self.priority_weights('ARTICLE_PRIORITY_CATEGORY_WEIGHTS').get(article.get('category_id'), 0)
+        )
+        age_minutes = min(max(age_minutes - weight, 0), max_age_minutes)
+
+        bucket_minutes = self.settings.getfloat('ARTICLE_PRIORITY_BUCKET_MINUTES') or 1
+        growth = max(self.settings.getfloat('ARTICLE_PRIORITY_BUCKET_GROWTH'), 1.01)
+        return -int(math.log(1 + age_minutes * (growth - 1) / bucket_minutes, growth))
+
+    def priority_weights(self, name: str) -> dict[int, float]:
+        # Keys set from the command line or as JSON are strings
+        return {int(key): float(weight) for key, weight in self.settings.getdict(name).items()}
 
     async def inline_request(self, request: Request | str) -> Response:
         _request = request if isinstance(request, Request) else Request(url=request)
         deferred = self.crawler.engine.download(_request)
         return await maybe_deferred_to_future(deferred)
+
+    def engine_options(self) -> dict:
+        return {
+            'pool_size': self.settings.getint('MYSQL_POOL_SIZE'),
+            'max_overflow': self.settings.getint('MYSQL_MAX_OVERFLOW'),
+            'pool_recycle': self.settings.getint('MYSQL_POOL_RECYCLE'),
+            'pool_pre_ping': self.settings.getbool('MYSQL_POOL_PRE_PING'),
+        }
+
+    def load_news_hash_index(self) -> NewsHashIndex:
+        preload_days = self.settings.getint('NEWS_HASH_INDEX_PRELOAD_DAYS')
+        since = int(time.time()) - preload_days * 86400 if preload_days > 0 else None
+
+        if self.settings.get('NEWS_HASH_INDEX') == 'bloom':
+            news_hash_index = BloomNewsHashIndex(
+                capacity=self.settings.getint('NEWS_HASH_INDEX_BLOOM_CAPACITY'),
+                error_rate=self.settings.getfloat('NEWS_HASH_INDEX_BLOOM_ERROR_RATE'),
+                since=since,
+            )
+        else:
+            news_hash_index = NewsHashIndex(since=since)
+
+        query = select(models.Article.news_hash).execution_options(yield_per=10_000)
+        if since is not None:
+            query = query.where(models.Article.created_at >= news_hash_index.since_datetime)
+
+        with models.Session() as session:
+            news_hash_index.update(session.execute(query).scalars())
+
+        self.logger.info(f'Preloaded {len(news_hash_index)} news hashes')
+        self.report_news_hash_index(news_hash_index)
+        return news_hash_index
+
+    def load_near_duplicate_index(self) -> NearDuplicateIndex:
+        near_duplicate_index = NearDuplicateIndex(
+            title_max_distance=self.settings.getint('NEAR_DUPLICATE_TITLE_MAX_DISTANCE'),
+            content_max_distance=self.settings.getint('NEAR_DUPLICATE_CONTENT_MAX_DISTANCE'),
+            title_shingle_size=self.settings.getint('NEAR_DUPLICATE_TITLE_SHINGLE_SIZE'),
+            title_min_tokens=self.settings.getint('NEAR_DUPLICATE_TITLE_MIN_TOKENS'),
+            content_shingle_size=self.settings.getint('NEAR_DUPLICATE_CONTENT_SHINGLE_SIZE'),
+            content_chars=self.settings.getint('NEAR_DUPLICATE_CONTENT_CHARS'),
+        )
+
+        since = datetime.fromtimestamp(time.time() - self.settings.getint('NEAR_DUPLICATE_INDEX_DAYS') * 86400,
+                                       timezone.utc)
+        simhashes = models.ArticleSimHash
+        query = (
+            select(simhashes.news_hash, simhashes.title_simhash, simhashes.content_simhash)
+            .where(simhashes.created_at >= since)
+            .execution_options(yield_per=10_000)
+        )
+
+        with models.Session() as session:
+            for news_hash, title_simhash, content_simhash in session.execute(query):
+                if title_simhash is not None:
+                    near_duplicate_index.titles.add(from_signed64(title_simhash), news_hash)
+                if content_simhash is not None:
+                    near_duplicate_index.contents.add(from_signed64(content_simhash), news_hash)
+
+        self.logger.info(f'Preloaded the SimHashes of {len(near_duplicate_index.contents)} articles')
+        self.crawler.stats.set_value('near_duplicate/preloaded', len(near_duplicate_index.contents))
+        return near_duplicate_index
+
+    def is_near_duplicate_title(self, article: ArticleItem) -> bool:
+        """
+        Returns True if the title of the article is a near duplicate of a stored or already requested one, otherwise
+        adds it to the index.
+        """
+        if self.near_duplicate_index is None:
+            return False
+
+        if (title_simhash := self.near_duplicate_index.title_simhash(article.get('title'))) is None:
+            return False
+        article['title_simhash'] = title_simhash
+
+        duplicate_of, collisions = self.near_duplicate_index.titles.find(title_simhash)
+        if collisions:
+            self.crawler.stats.inc_value('near_duplicate/title_collisions', collisions)
+        if duplicate_of is not None:
+            self.crawler.stats.inc_value('near_duplicate/title_skipped')
+            self.logger.debug(f'Skipped {article["source_url"]}, the title is a near duplicate of {duplicate_of}')
+            return True
+
+        self.near_duplicate_index.titles.add(title_simhash, article['news_hash'])
+        return False
+
+    @staticmethod
+    def article_hashes(article: ArticleItem) -> tuple[str, ...]:
+        if legacy_news_hash := article.get('legacy_news_hash'):
+            return article['news_hash'], legacy_news_hash
+        return article['news_hash'],
+
+    def find_stored_hashes(self, articles: list[ArticleItem]) -> set[str]:
+        """
+        Returns the news hashes (and legacy hashes) of the articles which are already stored.
+
+        The preloaded index answers for the articles it covers, everything else (and every positive of an inexact
+        index) is checked with a single batched query.
+        """
+        stored_hashes = set()
+        hashes_to_check = set()
+
+        for article in articles:
+            covered = self.news_hash_index.covers(article.get('created_at'))
+
+            for news_hash in self.article_hashes(article):
+                self.crawler.stats.inc_value('news_hash_index/lookups')
+
+                if not covered:
+                    self.crawler.stats.inc_value('news_hash_index/not_covered')
+                    hashes_to_check.add(news_hash)
+
+                elif news_hash in self.news_hash_index:
+                    if self.news_hash_index.exact:
+                        stored_hashes.add(news_hash)
+                    else:
+                        self.crawler.stats.inc_value('news_hash_index/positives')
+                        hashes_to_check.add(news_hash)
+
+        if hashes_to_check:
+            self.crawler.stats.inc_value('news_hash_index/db_queries')
+            with models.Session() as session:
+                found_hashes = set(session.scalars(
+                    select(models.Article.news_hash).where(models.Article.news_hash.in_(hashes_to_check))
+                ))
+
+            if not self.news_hash_index.exact:
+                for news_hash in hashes_to_check - found_hashes:
+                    if news_hash in self.news_hash_index:
+                        self.crawler.stats.inc_value('news_hash_index/false_positives')
+
+            stored_hashes |= found_hashes
+
+        return stored_hashes
+
+    def load_source_states(self) -> dict[int, dict]:
+        with models.Session() as session:
+            return {
+                source_state.source_id: {
+                    'etag': source_state.etag,
+                    'last_modified': source_state.last_modified,
+                    'body_digest': source_state.body_digest,
+                    'watermark': calendar.timegm(source_state.watermark.timetuple()) if source_state.watermark else None,
+                }
+                for source_state in session.scalars(select(models.ScraperSourceState))
+            }
+
+    def is_source_unchanged(self, response: Response, source_id: int) -> bool:
+        """
+        Returns True if the source has not changed since the previous run, either because the server answered
+        304 Not Modified or because the body is the same. Otherwise remembers the new validators of the source.
+        """
+        if not self.settings.getbool('SOURCE_CONDITIONAL_REQUESTS_ENABLED'):
+            return False
+
+        if response.status == 304:
+            self.crawler.stats.inc_value('source_state/not_modified')
+            return True
+
+        source_state = self.source_states.setdefault(source_id, {})
+        body_digest = hashlib.sha1(response.body).hexdigest()
+        if body_digest == source_state.get('body_digest'):
+            self.crawler.stats.inc_value('source_state/unchanged_body')
+            return True
+
+        source_state['etag'] = response.headers.get('ETag', b'').decode('latin-1') or None
+        source_state['last_modified'] = response.headers.get('Last-Modified', b'').decode('latin-1') or None
+        source_state['body_digest'] = body_digest
+        self.changed_source_ids.add(source_id)
+        self.crawler.stats.inc_value('source_state/changed')
+        return False
+
+    def save_source_states(self) -> None:
+        """
+        Saves the watermarks advanced during the run and the validators and body digests of the sources which have
+        changed. Sources with an article which failed are left as they were.
+        """
+        source_ids = (self.advanced_source_ids | self.changed_source_ids) - self.failed_source_ids
+        if not source_ids:
+            return
+
+        updated_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        rows = []
+        for source_id in source_ids:
+            source_state = self.source_states.get(source_id, {})
+            watermark = source_state.get('watermark')
+            rows.append({
+                'source_id': source_id,
+                'etag': source_state.get('etag'),
+                'last_modified': source_state.get('last_modified'),
+                'body_digest': source_state.get('body_digest'),
+                'watermark': datetime.fromtimestamp(watermark, timezone.utc).replace(tzinfo=None) if watermark else None,
+                'updated_at': updated_at,
+            })
+
+        with models.Session() as session:
+            session.execute(models.upsert(
+                session,
+                models.ScraperSourceState.__table__,
+                rows,
+                index_elements=['source_id'],
+                update_columns=['watermark', 'updated_at', 'etag', 'last_modified', 'body_digest'],
+            ))
+            session.commit()
+
+        self.logger.info(f'Saved the state of {len(rows)} sources')
+        self.changed_source_ids.clear()
+        self.advanced_source_ids.clear()
+
+    def on_items_stored(self, items: list[dict]) -> None:
+        """
+        Called by the MySQLPipeline once a batch of items is committed.
+        """
+        self.news_hash_index.update(item['news_hash'] for item in items)
+
+        # The watermark of a source only moves past articles which are stored
+        for item in items:
+            source_id, created_at = item.get('source_id'), item.get('created_at')
+            if source_id is None or created_at is None:
+                continue
+
+            source_state = self.source_states.setdefault(source_id, {})
+            if created_at > (source_state.get('watermark') or 0):
+                source_state['watermark'] = created_at
+                self.advanced_source_ids.add(source_id)
+
+    def on_items_failed(self, items: list[dict]) -> None:
+        """
+        Called by the MySQLPipeline for the items it could not store.
+        """
+        for item in items:
+            self.mark_source_failed(item.get('source_id'))
+
+    def report_news_hash_index(self, news_hash_index: NewsHashIndex) -> None:
+        stats = self.crawler.stats
+        stats.set_value('news_hash_index/size', len(news_hash_index))
+        stats.set_value('news_hash_index/memory_bytes', news_hash_index.memory_bytes())
+
+        if isinstance(news_hash_index, BloomNewsHashIndex):
+            stats.set_value('news_hash_index/expected_false_positive_rate', news_hash_index.expected_error_rate())
+            if positives := stats.get_value('news_hash_index/positives'):
+                false_positives = stats.get_value('news_hash_index/false_positives', 0)
+                stats.set_value('news_hash_index/false_positive_rate', false_positives / positives)
+
+    def closed(self, reason: str) -> Deferred | None:
+        if self.news_hash_index is not None:
+            self.report_news_hash_index(self.news_hash_index)
+
+        # An interrupted run leaves queued articles unstored, older than the newest stored one of their source: neither
+        # the validators nor the watermarks are saved, so the next run fetches the feeds again and requests them
+        if self.source_states is not None and reason == 'finished':
+            self.save_source_states()
+
+        # Scrapy waits for the leases to be released before closing
+        if self.source_shard is not None:
+            return self.source_shard.stop(finished=reason == 'finished')
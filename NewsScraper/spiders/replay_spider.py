@@ -0,0 +1,83 @@
+from typing import Iterable
+
+from scrapy import Request
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest
+from twisted.python.failure import Failure
+
+from NewsScraper.archive import ResponseArchive
+from NewsScraper.items import ArticleItem
+from NewsScraper.sharding import SourceRow, SourceShard
+from NewsScraper.spiders.base_spider import BaseNewsSpider
+
+
+class ReplayNewsSpider(BaseNewsSpider):
+    """
+    Re-processes the feeds and articles in the response archive through the same page objects and pipelines, without
+    the network: every request is answered by the ResponseArchiveMiddleware.
+
+    The archived feeds are parsed first and request every entry, stored or not (entries which are not archived are
+    ignored). Once the spider is idle, the archived articles no feed led to are replayed with the initial item they were
+    archived with.
+
+        scrapy crawl news_replay
+    """
+    name = 'news_replay'
+
+    custom_settings = {
+        **BaseNewsSpider.custom_settings,
+        'RESPONSE_ARCHIVE_REPLAY': True,
+        'ZYTE_API_TRANSPARENT_MODE': False,
+        'ADAPTIVE_SLOTS_ENABLED': False,
+        'DOWNLOAD_DELAY': 0,
+        'CRAWL_DEADLINE': 0,
+        # Every archived feed is parsed again and every entry of it requested
+        'SOURCE_CONDITIONAL_REQUESTS_ENABLED': False,
+        'SOURCE_WATERMARK_ENABLED': False,
+    }
+
+    pending_articles: list[dict] = None
+
+    def start_requests(self) -> Iterable[Request]:
+
+        self.init_db()
+        self.source_shard = SourceShard.from_crawler(self.crawler)
+
+        archive = ResponseArchive(self.settings.get('RESPONSE_ARCHIVE_DIR'), self.settings.getint('RESPONSE_ARCHIVE_MAX_BYTES'))
+        self.logger.info(f'Replaying {len(archive)} archived responses')
+
+        self.pending_articles = [header['init_item'] for header in archive.iter_headers(kind='article')]
+
+        for header in archive.iter_headers(kind='feed'):
+            # Feeds archived before their source was recorded cannot be attributed to one
+            if (source := header.get('source')) is None:
+                continue
+
+            request = self.source_request(SourceRow(
+                source_id=source['source_id'],
+                source_url=header['url'],
+                is_rss=source['is_rss'],
+                category_id=source['category_id'],
+                city_id=source['city_id'],
+            ))
+            yield request.replace(dont_filter=True)
+
+    def spider_idle(self) -> None:
+        if self.pending_articles is None:
+            return super().spider_idle()
+
+        pending_articles, self.pending_articles = self.pending_articles, None
+        for init_item in pending_articles:
+            if init_item['news_hash'] not in self.requested_hashes:
+                self.crawler.engine.crawl(self.article_request(ArticleItem(init_item)).replace(dont_filter=True))
+        raise DontCloseSpider
+
+    def article_failed(self, failure: Failure) -> None:
+        # Feed entries which are not archived, counted in response_archive/replay_missing
+        if failure.check(IgnoreRequest):
+            self.mark_source_failed(failure.request.cb_kwargs['init_item'].get('source_id'))
+            return
+        super().article_failed(failure)
+
+    def find_stored_hashes(self, articles: list[ArticleItem]) -> set[str]:
+        # The stored articles are re-processed too
+        return set()
@@ -1,8 +1,18 @@
+import codecs
+import functools
 import json
 import re
 
+import tldextract
 from parsel import Selector
-from tldextract import tldextract
+from tldextract.remote import lenient_netloc
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_ASSIGNMENT_RE = re.compile(rb'\s*=')
 
 
 def normalize_whitespaces(text: str) -> str:
@@ -28,5 +38,100 @@ def get_script_json(input_html: Selector | str, prefix_expr: str) -> dict:
         return json.loads(script_js)
 
 
+def get_script_json_fast(input_html: str | bytes, marker: str, encoding: str = 'utf-8') -> dict:
+    """
+    Same as :func:`get_script_json` for a script that starts with `marker` followed by an assignment, without
+    building a DOM of the page.
+
+    The assignment is cut out of the raw bytes, ``:undefined`` is replaced with ``:null`` as get_script_json does
+    (string values included), and the JSON is decoded with orjson when it is installed. Falls back to
+    :func:`get_script_json` when the script cannot be found or decoded this way, a payload which is not valid in
+    `encoding` included.
+    """
+    if isinstance(input_html, str):
+        html_bytes, encoding = input_html.encode('utf-8'), 'utf-8'
+    else:
+        html_bytes = input_html
+
+    marker_bytes = marker.encode(encoding)
+    position = html_bytes.find(marker_bytes)
+    while position != -1:
+        # The marker has to be the very beginning of a script's text
+        tag_start = html_bytes.rfind(b'<', 0, position)
+        if html_bytes[position - 1:position] == b'>' and html_bytes[tag_start:tag_start + 7].lower() == b'<script':
+            break
+        position = html_bytes.find(marker_bytes, position + len(marker_bytes))
+
+    if position != -1 and (assignment := _ASSIGNMENT_RE.match(html_bytes, position + len(marker_bytes))):
+        payload_start = assignment.end()
+        payload_end = html_bytes.find(b'</script', payload_start)
+
+        while payload_end > payload_start and html_bytes[payload_end - 1] in b' \t\r\n':
+            payload_end -= 1
+        if html_bytes[payload_end - 1:payload_end] == b';':
+            payload_end -= 1
+
+        if payload_end > payload_start:
+            payload = html_bytes[payload_start:payload_end]
+            try:
+                if codecs.lookup(encoding).name != 'utf-8':
+                    payload = payload.decode(encoding).encode('utf-8')
+                if b':undefined' in payload:
+                    payload = payload.replace(b':undefined', b':null')
+                return orjson.loads(payload) if orjson is not None else json.loads(payload)
+
+            # UnicodeDecodeError included
+            except ValueError:
+                pass
+
+    html_text = input_html if isinstance(input_html, str) else input_html.decode(encoding, errors='replace')
+    return get_script_json(html_text, rf'{re.escape(marker)}\s*=')
+
+
+class DomainResolver:
+    """
+    Resolves the registered domain of a URL from the public suffix list snapshot bundled with tldextract, so it never
+    goes to the network.
+
+    The results are memoized per host in a bounded LRU cache. Empty and relative URLs (paths, fragments, queries)
+    have no domain and are answered without calling tldextract.
+    """
+
+    RELATIVE_PREFIXES = ('#', '?', '.')
+
+    def __init__(self, cache_size: int = 10_000):
+        self.extract = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None, fallback_to_snapshot=True)
+        self.host_domain = functools.lru_cache(maxsize=cache_size)(self._host_domain)
+        self.relative = 0
+        self.reported = {}
+
+    def get_domain(self, url: str) -> str:
+        if not url or url.startswith(self.RELATIVE_PREFIXES) or (url[0] == '/' and url[1:2] != '/'):
+            self.relative += 1
+            return ''
+        return self.host_domain(lenient_netloc(url))
+
+    def _host_domain(self, host: str) -> str:
+        return self.extract.extract_str(host).registered_domain.lower()
+
+    def pop_stats(self) -> dict[str, int]:
+        """
+        Returns the counters gathered since the previous call, keyed by their stats name.
+        """
+        cache_info = self.host_domain.cache_info()
+        counters = {
+            'domain_resolver/cache_hits': cache_info.hits,
+            'domain_resolver/cache_misses': cache_info.misses,
+            'domain_resolver/relative': self.relative,
+        }
+
+        stats = {key: value - self.reported.get(key, 0) for key, value in counters.items()}
+        self.reported = counters
+        return {key: value for key, value in stats.items() if value}
+
+
+domain_resolver = DomainResolver()
+
+
 def get_domain(url: str) -> str:
-    return tldextract.extract(url).registered_domain.lower()
+    return domain_resolver.get_domain(url)
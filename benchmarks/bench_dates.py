@@ -0,0 +1,59 @@
+"""
+Compares dateparser.parse with the tiered FeedDateParser on feed dates in the formats seen in RSS and Atom feeds,
+and checks that both resolve every date to the same moment.
+
+The feed is polled `--polls` times, so from the second poll on the dates come from the FeedDateParser cache.
+
+    python -m benchmarks.bench_dates --polls 5
+"""
+import argparse
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import dateparser
+
+from NewsScraper.dates import FeedDateParser
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+
+def main(args: argparse.Namespace) -> int:
+    raw_dates = (FIXTURES_DIR / 'feed-dates.txt').read_text(encoding='utf-8').splitlines()
+
+    started = time.perf_counter()
+    expected = [dateparser.parse(raw_date) for raw_date in raw_dates]
+    dateparser_time = (time.perf_counter() - started) / len(raw_dates)
+
+    date_parser = FeedDateParser()
+    tiers = Counter()
+    mismatches = 0
+    started = time.perf_counter()
+    for raw_date, expected_date in zip(raw_dates, expected):
+        parsed_date, tier, _ = date_parser.parse(raw_date)
+        tiers[tier] += 1
+        if parsed_date != expected_date or parsed_date.utcoffset() != expected_date.utcoffset():
+            mismatches += 1
+            print(f'{raw_date!r}: {parsed_date} ({tier}) != {expected_date} (dateparser)')
+    cold_time = (time.perf_counter() - started) / len(raw_dates)
+
+    started = time.perf_counter()
+    for _ in range(args.polls - 1):
+        for raw_date in raw_dates:
+            date_parser.parse(raw_date)
+    warm_time = (time.perf_counter() - started) / max((args.polls - 1) * len(raw_dates), 1)
+
+    print(f'{len(raw_dates)} dates, tiers: {dict(tiers)}, {mismatches} mismatches')
+    print(f'{"dateparser":>22}: {dateparser_time * 1e6:.1f} us/date')
+    print(f'{"FeedDateParser (cold)":>22}: {cold_time * 1e6:.1f} us/date, {dateparser_time / cold_time:.0f}x')
+    if args.polls > 1:
+        print(f'{"FeedDateParser (warm)":>22}: {warm_time * 1e6:.2f} us/date, {dateparser_time / warm_time:.0f}x')
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--polls', type=int, default=5)
+    sys.exit(main(parser.parse_args()))
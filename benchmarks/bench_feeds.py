@@ -0,0 +1,67 @@
+"""
+Compares the feed engines on a generated RSS feed: the time to the first entry, the time to read all entries, and
+whether both engines return the same link, title, published date and media for every entry.
+
+    python -m benchmarks.bench_feeds --entries 5000 --rounds 5
+"""
+import argparse
+import sys
+import time
+from html import escape
+
+from NewsScraper.feeds import FEED_ENGINES
+
+FIELDS = ('link', 'title', 'published', 'media_content')
+
+
+def generate_feed(entries: int) -> bytes:
+    items = []
+    for index in range(entries):
+        items.append(
+            f'<item><title>{escape(f"Article {index} & more")}</title>'
+            f'<link>https://www.nytimes.com/2024/10/14/us/article-{index}.html</link>'
+            f'<description>{escape("<p>" + "Lorem ipsum dolor sit amet. " * 20 + "</p>")}</description>'
+            f'<pubDate>Mon, 14 Oct 2024 {index // 3600 % 24:02d}:{index // 60 % 60:02d}:{index % 60:02d} GMT</pubDate>'
+            f'<media:content url="https://static01.nyt.com/images/{index}.jpg" medium="image" width="1050"/></item>'
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<rss version="2.0" xmlns:media="http://search.yahoo.com/mrss/"><channel><title>NYT</title>'
+        + ''.join(items) + '</channel></rss>'
+    ).encode('utf-8')
+
+
+def main(args: argparse.Namespace) -> int:
+    body = generate_feed(args.entries)
+    engines = {name: engine_cls() for name, engine_cls in FEED_ENGINES.items()}
+
+    entries = {
+        name: [{field: entry.get(field) for field in FIELDS} for entry in engine.iter_entries(body)]
+        for name, engine in engines.items()
+    }
+    mismatches = sum(entry != expected for entry, expected in zip(entries['streaming'], entries['feedparser']))
+    mismatches += abs(len(entries['streaming']) - len(entries['feedparser']))
+
+    print(f'{args.entries} entries, {len(body) / 1e6:.1f} MB, {mismatches} mismatches')
+    for name, engine in engines.items():
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            next(iter(engine.iter_entries(body)))
+        first_entry = (time.perf_counter() - started) / args.rounds
+
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for _ in engine.iter_entries(body):
+                pass
+        all_entries = (time.perf_counter() - started) / args.rounds
+
+        print(f'{name:>10}: first entry {first_entry * 1000:.1f} ms, all entries {all_entries * 1000:.1f} ms')
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=5)
+    sys.exit(main(parser.parse_args()))
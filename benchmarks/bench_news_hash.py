@@ -0,0 +1,43 @@
+"""
+Compares the request fingerprint news_hash (a Request built per URL, SHA1 over a JSON blob) with the canonical URL
+hash, on the article URLs of the feed fixture and on copies of them with tracking parameters added.
+
+    python -m benchmarks.bench_news_hash --rounds 50
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from NewsScraper.dedup import canonical_news_hash, fingerprint_news_hash
+from NewsScraper.feeds import StreamingFeedEngine
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+TRACKING_SUFFIXES = ('', '?smid=nytcore-ios-share', '?utm_source=twitter&utm_medium=social', '#comments')
+
+
+def main(args: argparse.Namespace) -> int:
+    feed_body = (FIXTURES_DIR / 'nytimes-rss.xml').read_bytes()
+    article_urls = [entry['link'] for entry in StreamingFeedEngine().iter_entries(feed_body)]
+    urls = [url + suffix for url in article_urls for suffix in TRACKING_SUFFIXES]
+
+    timings = {}
+    for name, hash_url in (('fingerprint', fingerprint_news_hash), ('canonical', canonical_news_hash)):
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            hashes = [hash_url(url) for url in urls]
+        timings[name] = (time.perf_counter() - started) / (args.rounds * len(urls))
+        print(f'{name:>12}: {timings[name] * 1e6:.2f} us/url, '
+              f'{len(set(hashes))} distinct hashes for {len(article_urls)} articles')
+
+    print(f'canonical is {timings["fingerprint"] / timings["canonical"]:.1f}x faster')
+
+    # Every URL variant of an article must hash to the same value
+    return 0 if len({canonical_news_hash(url) for url in urls}) == len(set(article_urls)) else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=50)
+    sys.exit(main(parser.parse_args()))
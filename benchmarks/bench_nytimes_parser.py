@@ -0,0 +1,77 @@
+"""
+Times the NyTimesParser backends on the saved NYT article pages and checks that they produce the same markup.
+
+The markup is compared by its tags, attributes and text with the whitespace collapsed, since the bs4 backend
+indents its output and the html backend does not. Text runs glued together by one backend and separated by the other
+count as a difference.
+
+    python -m benchmarks.bench_nytimes_parser --rounds 20
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from NewsScraper.poet_pages.nytimes_pages import NYTIMES_PARSERS
+from NewsScraper.utils import get_script_json_fast
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+
+def measure(func, pages: list, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for page in pages:
+            func(page)
+    return (time.perf_counter() - started) / (rounds * len(pages))
+
+
+def measure_peak_memory(func, pages: list) -> int:
+    peaks = []
+    for page in pages:
+        tracemalloc.start()
+        func(page)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return max(peaks)
+
+
+def markup_signature(content: str) -> tuple[list, str]:
+    content_bs = BeautifulSoup(content, 'html.parser')
+    tags = [(tag.name, sorted(tag.attrs.items())) for tag in content_bs.find_all(True)]
+    return tags, ' '.join(content_bs.get_text().split())
+
+
+def main(args: argparse.Namespace) -> int:
+    fixture_paths = sorted(FIXTURES_DIR.glob('nytimes-*.html'))
+    pages = [fixture_path.read_bytes() for fixture_path in fixture_paths]
+    parsers = {name: parser_cls() for name, parser_cls in NYTIMES_PARSERS.items()}
+
+    mismatches = 0
+    outputs = {name: [parser.parse(page) for page in pages] for name, parser in parsers.items()}
+    for name, contents in outputs.items():
+        for fixture_path, content, expected in zip(fixture_paths, contents, outputs['bs4']):
+            if markup_signature(content) != markup_signature(expected):
+                mismatches += 1
+                print(f'{name}: markup differs from bs4 for {fixture_path.name}')
+
+    extraction = measure(lambda page: get_script_json_fast(page, 'window.__preloadedData'), pages, args.rounds)
+    print(f'{"json extraction":>16}: {extraction * 1000:.3f} ms/page')
+
+    timings = {name: measure(parser.parse, pages, args.rounds) for name, parser in parsers.items()}
+    for name, parser in parsers.items():
+        output_chars = sum(len(content) for content in outputs[name]) / len(pages)
+        peak_memory = measure_peak_memory(parser.parse, pages)
+        print(f'{name:>16}: {timings[name] * 1000:.3f} ms/page, {timings["bs4"] / timings[name]:.1f}x, '
+              f'{output_chars:.0f} chars/page, {peak_memory / 1024:.0f} KiB peak')
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--rounds', type=int, default=20)
+    sys.exit(main(arg_parser.parse_args()))
@@ -0,0 +1,77 @@
+"""
+Checks that every content sanitizer engine produces the same output as the BeautifulSoup one and compares their speed.
+The lxml engine hands misnested markup, and markup html.parser reads differently, to the BeautifulSoup one, the number
+of such items is reported.
+
+The corpus is the NyTimesParser output of the article fixtures plus the edge cases in sanitizer-edge-cases.json.
+
+    python -m benchmarks.bench_sanitizer --rounds 20
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from lxml import etree
+
+from NewsScraper.poet_pages.nytimes_pages import NyTimesParser
+from NewsScraper.sanitizers import SANITIZERS
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+
+def load_corpus() -> list[tuple[str, str]]:
+    corpus = []
+    for fixture_path in sorted(FIXTURES_DIR.glob('nytimes-*.html')):
+        content = NyTimesParser().parse(fixture_path.read_text(encoding='utf-8'))
+        corpus.append((f'https://www.nytimes.com/2024/10/01/us/{fixture_path.stem}.html', content))
+
+    for edge_case in json.loads((FIXTURES_DIR / 'sanitizer-edge-cases.json').read_text(encoding='utf-8')):
+        corpus.append((edge_case['source_url'], edge_case['content']))
+
+    return corpus
+
+
+def main(args: argparse.Namespace) -> int:
+    corpus = load_corpus()
+    sanitizers = {name: sanitizer_cls() for name, sanitizer_cls in SANITIZERS.items()}
+
+    expected = [sanitizers['bs4'].sanitize(content, source_url) for source_url, content in corpus]
+    mismatches = 0
+    for name, sanitizer in sanitizers.items():
+        for (source_url, content), expected_result in zip(corpus, expected):
+            if sanitizer.sanitize(content, source_url) != expected_result:
+                mismatches += 1
+                print(f'{name}: output differs from bs4 for {content[:60]!r}')
+
+    lxml_sanitizer = sanitizers['lxml']
+    fallbacks = 0
+    for _, content in corpus:
+        if lxml_sanitizer.needs_fallback(content):
+            fallbacks += 1
+            continue
+        body = etree.fromstring(f'<html><body>{content}', lxml_sanitizer.parser).find('body')
+        fallbacks += lxml_sanitizer.tree_events(body) != lxml_sanitizer.html_parser_tree_events(content)
+    print(f'lxml: {fallbacks} of {len(corpus)} items are sanitized by bs4')
+
+    total_bytes = sum(len(content.encode()) for _, content in corpus)
+    timings = {}
+    for name, sanitizer in sanitizers.items():
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for source_url, content in corpus:
+                sanitizer.sanitize(content, source_url)
+        timings[name] = (time.perf_counter() - started) / (args.rounds * len(corpus))
+
+    for name, per_item in timings.items():
+        print(f'{name:>6}: {per_item * 1000:.2f} ms/item, {total_bytes / len(corpus) / per_item / 1e6:.1f} MB/s, '
+              f'{timings["bs4"] / per_item:.1f}x')
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=20)
+    sys.exit(main(parser.parse_args()))
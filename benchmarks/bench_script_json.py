@@ -0,0 +1,80 @@
+"""
+Checks that get_script_json_fast returns the same as get_script_json on the saved NYT article pages and on the edge
+cases below, then compares their speed on the pages.
+
+    python -m benchmarks.bench_script_json --rounds 50
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import NewsScraper.utils as utils
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+MARKER = 'window.__preloadedData'
+
+# (page, encoding of the page)
+EDGE_CASES = [
+    # :undefined inside a string value is replaced too
+    (b'<script>window.__preloadedData = {"a":undefined,"text":"x:undefined y","b":[1,2]};</script>', 'utf-8'),
+    # Not valid UTF-8, the page is decoded with replacement characters instead
+    ('<script>window.__preloadedData = {"city":"Montr\u00e9al"}</script>'.encode('latin-1'), 'utf-8'),
+    ('<script>window.__preloadedData = {"city":"M\u00fcnchen"};</script>'.encode('cp1252'), 'ascii'),
+    ('<script>window.__preloadedData = {"city":"M\u00fcnchen"};</script>'.encode('cp1252'), 'cp1252'),
+]
+
+
+def measure(func, pages: list, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for page in pages:
+            func(page)
+    return (time.perf_counter() - started) / (rounds * len(pages))
+
+
+def count_mismatches(pages: list[tuple[bytes, str]]) -> int:
+    mismatches = 0
+    for page, encoding in pages:
+        expected = utils.get_script_json(page.decode(encoding, errors='replace'), rf'{MARKER}\s*=')
+        if utils.get_script_json_fast(page, MARKER, encoding) != expected:
+            mismatches += 1
+            print(f'get_script_json_fast differs from get_script_json for {page[:80]!r}')
+    return mismatches
+
+
+def main(args: argparse.Namespace) -> int:
+    pages = [fixture_path.read_bytes() for fixture_path in sorted(FIXTURES_DIR.glob('nytimes-*.html'))]
+    page_texts = [page.decode('utf-8') for page in pages]
+    orjson = utils.orjson
+
+    comparison_pages = [(page, 'utf-8') for page in pages] + EDGE_CASES
+    mismatches = count_mismatches(comparison_pages)
+    utils.orjson = None
+    mismatches += count_mismatches(comparison_pages)
+    utils.orjson = orjson
+
+    results = {
+        'get_script_json (str)': measure(
+            lambda page: utils.get_script_json(page, r'window.__preloadedData\s*='), page_texts, args.rounds),
+        'get_script_json_fast (bytes, orjson)': measure(
+            lambda page: utils.get_script_json_fast(page, MARKER), pages, args.rounds),
+    }
+
+    utils.orjson = None
+    results['get_script_json_fast (bytes, json)'] = measure(
+        lambda page: utils.get_script_json_fast(page, MARKER), pages, args.rounds)
+    utils.orjson = orjson
+
+    baseline = results['get_script_json (str)']
+    for name, per_page in results.items():
+        print(f'{name:>38}: {per_page * 1000:.3f} ms/page, {baseline / per_page:.1f}x')
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=50)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,136 @@
+"""
+Runs the data migrations against a fresh SQLite stand-in seeded with the rows they have to handle, and exits with 1
+when one of them leaves the data wrong.
+
+    python -m benchmarks.check_migrations
+"""
+import argparse
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import insert, select, text
+
+import NewsScraper.newsdb.models as models
+from NewsScraper.dedup import canonical_news_hash, fingerprint_news_hash
+from NewsScraper.newsdb.migrations import (
+    has_column, migrate_article_content_digest, migrate_canonical_news_hash, migrate_compress_article_content,
+)
+from benchmarks.bench_db import create_sqlite_standin
+
+
+def article(news_hash: str, source_url: str, day: int) -> dict:
+    # Core inserts, the ORM would send article_id as NULL instead of leaving it to the stand-in's default
+    return {
+        'title': source_url, 'slug': news_hash, 'content': 'x', 'journalist_id': 1, 'category_id': 1, 'city_id': 1,
+        'created_at': datetime(2024, 1, day), 'news_hash': news_hash, 'source_url': source_url,
+    }
+
+
+def check_canonical_news_hash(delete_duplicates: bool) -> list[str]:
+    """
+    A legacy (fingerprint) row and a newer row stored in compat mode under the canonical hash of the same story,
+    plus two legacy rows sharing a canonical hash and a legacy row of its own.
+    """
+    story_url = 'https://www.example.com/story.html'
+    legacy_story = fingerprint_news_hash(f'{story_url}?utm_source=feed')
+    compat_story = canonical_news_hash(story_url)
+    pair_url = 'https://www.example.com/pair.html'
+    legacy_pair = [fingerprint_news_hash(pair_url), fingerprint_news_hash(f'{pair_url}?utm_medium=rss')]
+    single_url = 'https://www.example.com/single.html'
+
+    with models.Session() as session:
+        session.execute(insert(models.Article.__table__), [
+            article(legacy_story, f'{story_url}?utm_source=feed', 1),
+            article(compat_story, story_url, 2),
+            article(legacy_pair[0], pair_url, 3),
+            article(legacy_pair[1], f'{pair_url}?utm_medium=rss', 4),
+            article(fingerprint_news_hash(single_url), single_url, 5),
+        ])
+        session.commit()
+
+        migrate_canonical_news_hash(session, argparse.Namespace(
+            batch_size=2, dry_run=False, delete_duplicates=delete_duplicates))
+        stored = {news_hash: created_at.day for news_hash, created_at in
+                  session.execute(select(models.Article.news_hash, models.Article.created_at))}
+
+    expected = {compat_story: 2, canonical_news_hash(pair_url): 3, canonical_news_hash(single_url): 5}
+    if not delete_duplicates:
+        expected.update({legacy_story: 1, legacy_pair[1]: 4})
+
+    if stored != expected:
+        return [f'canonical_news_hash (delete_duplicates={delete_duplicates}): {stored} != {expected}']
+    return []
+
+
+def check_compress_article_content() -> list[str]:
+    """
+    --add-column-only adds content_body to a database from before it and leaves the content, the next run moves it.
+    """
+    failures = []
+    with models.Session() as session:
+        session.execute(text('ALTER TABLE articles DROP COLUMN content_body'))
+        session.execute(insert(models.Article.__table__), [
+            article('a' * 40, 'https://www.example.com/a.html', 1) | {'content': 'body'},
+        ])
+        session.commit()
+
+        args = argparse.Namespace(batch_size=10, dry_run=False, add_column_only=True)
+        migrate_compress_article_content(session, args)
+        stored = session.execute(text('SELECT content, content_body FROM articles')).one()
+        if not has_column(session, 'articles', 'content_body') or tuple(stored) != ('body', None):
+            failures.append(f'compress_article_content --add-column-only: {tuple(stored)}')
+
+        migrate_compress_article_content(session, argparse.Namespace(**vars(args) | {'add_column_only': False}))
+        stored = session.execute(select(models.Article.content, models.Article.content_body)).one()
+        if tuple(stored) != ('', 'body'):
+            failures.append(f'compress_article_content: {tuple(stored)}')
+    return failures
+
+
+def check_article_content_digest() -> list[str]:
+    """
+    A "text" storage database without content_body (nor content_digest yet) gets the digests the pipeline computes.
+    """
+    row = article('b' * 40, 'https://www.example.com/b.html', 1)
+    with models.Session() as session:
+        session.execute(text('ALTER TABLE articles DROP COLUMN content_body'))
+        session.execute(text('ALTER TABLE articles DROP COLUMN content_digest'))
+        session.execute(insert(models.Article.__table__), [row])
+        session.commit()
+
+        migrate_article_content_digest(session, argparse.Namespace(batch_size=10, dry_run=False, add_column_only=False))
+        stored = session.scalar(text('SELECT content_digest FROM articles'))
+
+    if stored != models.article_digest(row):
+        return [f'article_content_digest: {stored} != {models.article_digest(row)}']
+    return []
+
+
+CHECKS = [
+    lambda: check_canonical_news_hash(delete_duplicates=False),
+    lambda: check_canonical_news_hash(delete_duplicates=True),
+    check_compress_article_content,
+    check_article_content_digest,
+]
+
+
+def main(args: argparse.Namespace) -> int:
+    failures = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for number, check in enumerate(CHECKS):
+            connection_string = f'sqlite:///{Path(temp_dir) / f"check-{number}.db"}'
+            create_sqlite_standin(connection_string)
+            models.init_db(connection_string)
+            failures += check()
+
+    for failure in failures:
+        print(f'FAILED {failure}')
+    print(f'{len(CHECKS) - len(failures)} of {len(CHECKS)} checks passed')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,241 @@
+"""
+Benchmark suite of the CPU-bound stages of a run, over the checked-in fixtures and without the network.
+
+Every stage reports its throughput, the per-call latency percentiles and the peak memory (traced Python
+allocations) of a single call, each the median of --repeat measurements. `run` writes the results as JSON,
+`compare` fails when a stage of the baseline is missing, or is slower or uses more memory than the baseline by more
+than the threshold and by more than the absolute MIN_DELTAS, so that noise on tiny values is not a regression.
+
+    python -m benchmarks.suite run --output results.json --repeat 5
+    python -m benchmarks.suite compare benchmarks/baseline.json results.json --threshold 0.25
+    python -m benchmarks.suite run --compare benchmarks/baseline.json
+
+The baseline is machine dependent, refresh it with `run --output benchmarks/baseline.json` on the machine that
+runs the comparison.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+import web_poet
+
+from NewsScraper.items import ArticleItem
+from NewsScraper.loaders import ArticleItemLoader
+from NewsScraper.pipelines import DefaultPipeline
+from NewsScraper.poet_pages.base_pages import ArticleRssPage
+from NewsScraper.poet_pages.nytimes_pages import NYTIMES_PARSERS
+from NewsScraper.utils import get_script_json, get_script_json_fast
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+BASELINE_PATH = Path(__file__).parent / 'baseline.json'
+
+# The smallest change of a compared metric which can be a regression, whatever the relative change
+MIN_DELTAS = {
+    'p50_ms': 0.1,
+    'peak_memory_kib': 64,
+}
+
+
+class Stage:
+    """
+    A function and the inputs it is called with, one call per input.
+    """
+
+    def __init__(self, name: str, func: Callable, inputs: list):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+
+    def measure_median(self, rounds: int, repeat: int) -> dict:
+        """
+        The median of every metric over `repeat` measurements.
+        """
+        measurements = [self.measure(rounds) for _ in range(max(repeat, 1))]
+        return {metric: statistics.median(measurement[metric] for measurement in measurements)
+                for metric in measurements[0]}
+
+    def measure(self, rounds: int, warmup: int = 1) -> dict:
+        for _ in range(warmup):
+            for stage_input in self.inputs:
+                self.func(stage_input)
+
+        # The collector is off while timing, as in timeit, so its pauses do not land on random calls
+        gc.collect()
+        gc.disable()
+        try:
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(rounds):
+                for stage_input in self.inputs:
+                    call_started = time.perf_counter()
+                    self.func(stage_input)
+                    latencies.append(time.perf_counter() - call_started)
+            elapsed = time.perf_counter() - started
+        finally:
+            gc.enable()
+
+        peak_memory = 0
+        for stage_input in self.inputs:
+            tracemalloc.start()
+            self.func(stage_input)
+            peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+        return {
+            'calls': len(latencies),
+            'calls_per_second': round(len(latencies) / elapsed, 2),
+            'mean_ms': round(statistics.fmean(latencies) * 1000, 4),
+            'p50_ms': round(quantiles[49] * 1000, 4),
+            'p95_ms': round(quantiles[94] * 1000, 4),
+            'p99_ms': round(quantiles[98] * 1000, 4),
+            'peak_memory_kib': round(peak_memory / 1024, 1),
+        }
+
+
+def load_article_pages() -> list[bytes]:
+    return [fixture_path.read_bytes() for fixture_path in sorted(FIXTURES_DIR.glob('nytimes-*.html'))]
+
+
+def build_stages() -> list[Stage]:
+    article_pages = load_article_pages()
+    article_texts = [page.decode('utf-8') for page in article_pages]
+    feed_body = (FIXTURES_DIR / 'nytimes-rss.xml').read_bytes()
+
+    stages = [
+        Stage('get_script_json', lambda page: get_script_json(page, r'window.__preloadedData\s*='), article_texts),
+        Stage('get_script_json_fast', lambda page: get_script_json_fast(page, 'window.__preloadedData'), article_pages),
+    ]
+
+    for backend, parser_cls in NYTIMES_PARSERS.items():
+        stages.append(Stage(f'nytimes_parser.{backend}', parser_cls().parse, article_pages))
+
+    def parse_feed(feed_engine: str) -> list[ArticleItem]:
+        page = ArticleRssPage(
+            response=web_poet.HttpResponse('https://rss.nytimes.com/services/xml/rss/nyt/US.xml', body=feed_body),
+            http=None,
+            page_params=web_poet.PageParams({'feed_engine': feed_engine}),
+            stats=web_poet.Stats(),
+        )
+        return list(page.parse_articles())
+
+    for feed_engine in ('streaming', 'feedparser'):
+        stages.append(Stage(f'rss_parse_articles.{feed_engine}', parse_feed, [feed_engine]))
+
+    feed_items = parse_feed('streaming')
+    now = datetime.now(timezone.utc)
+
+    def load_item(feed_item: ArticleItem, news_hash_mode: str = 'compat') -> ArticleItem:
+        item_loader = ArticleItemLoader(news_hash_mode=news_hash_mode)
+        item_loader.add_value('source_url', feed_item['source_url'])
+        item_loader.add_value('title', feed_item['title'])
+        item_loader.add_value('created_at', now)
+        item_loader.add_value('featured_image', feed_item.get('featured_image'))
+        return item_loader.load_item()
+
+    stages.append(Stage('item_loader.load_item', load_item, feed_items))
+    stages.append(Stage('item_loader.load_item.canonical', lambda item: load_item(item, 'canonical'), feed_items))
+
+    pipeline = DefaultPipeline()
+    event_loop = asyncio.new_event_loop()
+    contents = [NYTIMES_PARSERS['html']().parse(page) for page in article_pages]
+
+    def process_item(content: str) -> ArticleItem:
+        item = ArticleItem(feed_items[0], content=content)
+        return event_loop.run_until_complete(pipeline.process_item(item, None))
+
+    stages.append(Stage('default_pipeline.process_item', process_item, contents))
+    return stages
+
+
+def run(args: argparse.Namespace) -> int:
+    stages = build_stages()
+    if args.stage:
+        stages = [stage for stage in stages if any(name in stage.name for name in args.stage)]
+
+    results = {
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'rounds': args.rounds,
+        'repeat': args.repeat,
+        'stages': {},
+    }
+
+    for stage in stages:
+        results['stages'][stage.name] = stage_result = stage.measure_median(args.rounds, args.repeat)
+        print(f'{stage.name:>36}: {stage_result["calls_per_second"]:>10.1f} calls/s, '
+              f'p50 {stage_result["p50_ms"]:.3f} ms, p95 {stage_result["p95_ms"]:.3f} ms, '
+              f'p99 {stage_result["p99_ms"]:.3f} ms, peak {stage_result["peak_memory_kib"]:.0f} KiB')
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + '\n', encoding='utf-8')
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        if args.stage:
+            # The stages left out on purpose are not missing
+            baseline['stages'] = {name: stage for name, stage in baseline['stages'].items()
+                                  if any(stage_filter in name for stage_filter in args.stage)}
+        return compare_results(baseline, results, args.threshold)
+    return 0
+
+
+def compare_results(baseline: dict, results: dict, threshold: float) -> int:
+    """
+    Returns 1 if any stage of the baseline is missing from the results, or if its p50 latency or peak memory grew by
+    more than `threshold` and by more than the metric's MIN_DELTAS.
+    """
+    regressions = 0
+    for name, baseline_stage in baseline['stages'].items():
+        if (stage := results['stages'].get(name)) is None:
+            print(f'{name:>36}: missing from the results REGRESSION')
+            regressions += 1
+            continue
+
+        for metric, min_delta in MIN_DELTAS.items():
+            change = stage[metric] / baseline_stage[metric] - 1 if baseline_stage[metric] else 0
+            regressed = change > threshold and stage[metric] - baseline_stage[metric] > min_delta
+            regressions += regressed
+            print(f'{name:>36}: {metric} {baseline_stage[metric]} -> {stage[metric]} '
+                  f'({change:+.1%}){" REGRESSION" if regressed else ""}')
+
+    return 1 if regressions else 0
+
+
+def compare(args: argparse.Namespace) -> int:
+    baseline = json.loads(Path(args.baseline).read_text(encoding='utf-8'))
+    results = json.loads(Path(args.results).read_text(encoding='utf-8'))
+    return compare_results(baseline, results, args.threshold)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='measure the stages')
+    run_parser.add_argument('--rounds', type=int, default=20)
+    run_parser.add_argument('--repeat', type=int, default=3, help='measurements per stage, the median is reported')
+    run_parser.add_argument('--stage', action='append', help='only the stages whose name contains this, repeatable')
+    run_parser.add_argument('--output', help='write the results to this JSON file')
+    run_parser.add_argument('--compare', nargs='?', const=str(BASELINE_PATH), help='compare with a baseline file')
+    run_parser.add_argument('--threshold', type=float, default=0.25)
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.25)
+    compare_parser.set_defaults(handler=compare)
+
+    arguments = parser.parse_args()
+    sys.exit(arguments.handler(arguments))